@@ -0,0 +1,155 @@
+import argparse
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from iv2swc import iter_iv_filaments, filaments2dic, dic2swc
+
+
+def find_iv_files(root_directory):
+    # Recursively find all *.iv files below root_directory (sorted for a reproducible order)
+    iv_file_paths = []
+    for directory, _, file_names in os.walk(root_directory):
+        for file_name in file_names:
+            if file_name.lower().endswith('.iv'):
+                iv_file_paths.append(os.path.join(directory, file_name))
+    return sorted(iv_file_paths)
+
+
+def get_swc_path(iv_file_path, root_directory, output_directory=None):
+    # Same name as the iv file with an *.swc extension, next to it or mirrored below output_directory
+    swc_file_path = iv_file_path[:-3] + '.swc'
+    if output_directory is not None:
+        swc_file_path = os.path.join(output_directory, os.path.relpath(swc_file_path, root_directory))
+    return swc_file_path
+
+
+def file_hash(file_path):
+    # SHA-256 of the file content, read in blocks
+    sha256 = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def is_up_to_date(iv_file_path, swc_file_path, check, previous_entry):
+    # check: 'mtime' - the swc file is newer than the iv file
+    #        'hash'  - the iv content hash matches the one recorded in the previous manifest
+    # Files whose last conversion failed are never up to date (an older swc file may still exist)
+    if not os.path.exists(swc_file_path):
+        return False
+    if previous_entry is not None and previous_entry.get('status') == 'failed':
+        return False
+    if check == 'mtime':
+        return os.path.getmtime(swc_file_path) >= os.path.getmtime(iv_file_path)
+    if check == 'hash':
+        return previous_entry is not None and previous_entry.get('sha256') == file_hash(iv_file_path)
+    return False
+
+
+def convert_iv_file(iv_file_path, swc_file_path):
+    # Convert a single iv file and return its manifest entry; failures are recorded instead of raised
+    entry = {'iv_path': iv_file_path, 'swc_path': swc_file_path}
+    start_time = time.perf_counter()
+    try:
+        sha256 = file_hash(iv_file_path)
+        filaments_coord, filaments_struct_identifier = filaments2dic(iter_iv_filaments(iv_file_path))
+        swc_txt = dic2swc(filaments_coord, filaments_struct_identifier)
+        os.makedirs(os.path.dirname(os.path.abspath(swc_file_path)), exist_ok=True)
+        with open(swc_file_path, 'w') as f:
+            f.write(swc_txt)
+        entry['status'] = 'converted'
+        # Recorded only for converted files, so that the hash check never skips a failed file
+        entry['sha256'] = sha256
+        entry['n_filaments'] = len(filaments_coord)
+        entry['n_nodes'] = swc_txt.count('\n')
+    except Exception as error:
+        entry['status'] = 'failed'
+        entry['error'] = f'{type(error).__name__}: {error}'
+    entry['seconds'] = time.perf_counter() - start_time
+    return entry
+
+
+def load_manifest(manifest_path):
+    if manifest_path is None or not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path, 'r') as f:
+        manifest = json.load(f)
+    return {entry['iv_path']: entry for entry in manifest.get('files', [])}
+
+
+def batch_iv2swc(root_directory, output_directory=None, workers=None, check='mtime', manifest_path=None,
+                 force=False):
+    # Convert every *.iv file below root_directory to *.swc over a process pool
+    # Up to date outputs are skipped (check: 'mtime' or 'hash'), and a manifest with timings, node counts and failures
+    # is written to manifest_path (default: iv2swc_manifest.json in root_directory)
+    if manifest_path is None:
+        manifest_path = os.path.join(root_directory, 'iv2swc_manifest.json')
+    previous_entries = load_manifest(manifest_path)
+    start_time = time.perf_counter()
+
+    iv_file_paths = find_iv_files(root_directory)
+    print(len(iv_file_paths), ' iv files found in ', root_directory)
+    entries = []
+    jobs = []
+    for iv_file_path in iv_file_paths:
+        swc_file_path = get_swc_path(iv_file_path, root_directory, output_directory)
+        previous_entry = previous_entries.get(iv_file_path)
+        if not force and is_up_to_date(iv_file_path, swc_file_path, check, previous_entry):
+            entry = dict(previous_entry) if previous_entry is not None else {'iv_path': iv_file_path,
+                                                                             'swc_path': swc_file_path}
+            entry['status'] = 'skipped'
+            entry['seconds'] = 0.0
+            entries.append(entry)
+        else:
+            jobs.append((iv_file_path, swc_file_path))
+
+    print('Converting ', len(jobs), ' files (', len(entries), ' up to date)...', flush=True)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(convert_iv_file, iv_file_path, swc_file_path)
+                   for iv_file_path, swc_file_path in jobs]
+        for n_done, future in enumerate(as_completed(futures), start=1):
+            entry = future.result()
+            entries.append(entry)
+            if entry['status'] == 'failed':
+                print('\tFAILED ', entry['iv_path'], ': ', entry['error'])
+            if n_done % 100 == 0 or n_done == len(futures):
+                print('\t', n_done, '/', len(futures), ' done', flush=True)
+
+    entries.sort(key=lambda entry: entry['iv_path'])
+    summary = {
+        'root_directory': root_directory,
+        'n_files': len(entries),
+        'n_converted': sum(entry['status'] == 'converted' for entry in entries),
+        'n_skipped': sum(entry['status'] == 'skipped' for entry in entries),
+        'n_failed': sum(entry['status'] == 'failed' for entry in entries),
+        'n_nodes': sum(entry.get('n_nodes', 0) for entry in entries if entry['status'] != 'failed'),
+        'seconds': time.perf_counter() - start_time,
+    }
+    with open(manifest_path, 'w') as f:
+        json.dump({'summary': summary, 'files': entries}, f, indent=1)
+    print('Converted ', summary['n_converted'], ', skipped ', summary['n_skipped'], ', failed ', summary['n_failed'],
+          ' in ', round(summary['seconds'], 1), 's. Manifest: ', manifest_path)
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert all *.iv files of a directory tree to *.swc')
+    parser.add_argument('root_directory', help='directory searched recursively for *.iv files')
+    parser.add_argument('-o', '--output-directory', default=None,
+                        help='write the swc files below this directory (mirroring the tree) instead of next to the iv')
+    parser.add_argument('-w', '--workers', type=int, default=None, help='number of processes (default: all cores)')
+    parser.add_argument('--check', choices=['mtime', 'hash'], default='mtime',
+                        help='how to decide that an existing swc file is up to date')
+    parser.add_argument('--manifest', default=None, help='path of the json manifest')
+    parser.add_argument('--force', action='store_true', help='convert all files, even if up to date')
+    args = parser.parse_args()
+    summary = batch_iv2swc(args.root_directory, output_directory=args.output_directory, workers=args.workers,
+                           check=args.check, manifest_path=args.manifest, force=args.force)
+    return 1 if summary['n_failed'] else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
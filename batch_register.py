@@ -0,0 +1,224 @@
+import argparse
+import contextlib
+import glob
+import json
+import multiprocessing
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from registration import register_specimen
+from instrumentation import get_stage_totals
+
+REPORT_FIELDS = ('home_directory', 'status', 'attempts', 'seconds', 'quality_flags', 'error')
+
+
+def find_specimen_directories(specimens):
+    # Expand a list of specimen directories and/or glob patterns into a sorted list of directories
+    specimen_directories = set()
+    for specimen in specimens:
+        matches = glob.glob(specimen) if glob.has_magic(specimen) else [specimen]
+        specimen_directories.update(os.path.abspath(match) for match in matches if os.path.isdir(match))
+    return sorted(specimen_directories)
+
+
+def limit_memory(max_memory_gb):
+    # Limit the address space of the current (worker) process; only supported on unix
+    # The address space includes memory-mapped files and the reserved stacks of the resampling threads, so the limit
+    # must be well above the resident memory of a job, and it cannot be combined with out_of_core
+    if max_memory_gb is None:
+        return
+    try:
+        import resource
+    except ImportError:
+        print("WARNING: per-job memory limits are not supported on this platform")
+        return
+    max_memory_bytes = int(max_memory_gb * 1024 ** 3)
+    resource.setrlimit(resource.RLIMIT_AS, (max_memory_bytes, max_memory_bytes))
+
+
+def run_registration_job(config):
+    # Register one specimen, logging its output to <home_directory>/registration.log; failures are reported, not raised
+    job_status = {'home_directory': config['home_directory']}
+    start_time = time.perf_counter()
+    log_path = os.path.join(config['home_directory'], 'registration.log')
+    with open(log_path, 'w') as log, contextlib.redirect_stdout(log):
+        try:
+            results = register_specimen(config)
+            job_status['status'] = 'done'
+            job_status['outputs'] = {key: value for key, value in results.items()
+                                     if key.endswith('_path') and value is not None}
+            # Time and peak memory per stage, to spot the stage that regresses on larger volumes
+            job_status['stages'] = get_stage_totals(results['stage_records'])
+            # Registrations whose quality metrics cross the thresholds are listed for review
+            if results['quality'] is not None:
+                job_status['quality'] = {key: results['quality'][key] for key in ('landmark_error',
+                                         'leave_one_out_error', 'jacobian', 'similarity')}
+                job_status['quality_flags'] = results['quality']['flags']
+        except Exception as error:
+            traceback.print_exc(file=log)
+            job_status['status'] = 'failed'
+            job_status['error'] = f'{type(error).__name__}: {error}'
+    job_status['seconds'] = time.perf_counter() - start_time
+    return job_status
+
+
+def write_report(report_path, report):
+    # Write the job report as json, and as a csv table next to it
+    with open(report_path, 'w') as f:
+        json.dump(report, f, indent=1)
+    with open(os.path.splitext(report_path)[0] + '.csv', 'w') as f:
+        f.write(','.join(REPORT_FIELDS) + '\n')
+        for job_status in report['jobs']:
+            f.write(','.join('"' + str(job_status.get(field, '')).replace('"', "'") + '"'
+                             for field in REPORT_FIELDS) + '\n')
+
+
+def run_started_job(config, started_jobs):
+    # Mark the job as started (synchronously, through the manager process) before registering the specimen, so that
+    # the jobs running when a worker dies can be told from the jobs still waiting in the queue of the pool
+    started_jobs[config['home_directory']] = True
+    return run_registration_job(config)
+
+
+def run_jobs(specimen_directories, base_config, workers, max_memory_gb):
+    # Register specimens over a fresh process pool (a worker killed by the system, e.g. out of memory, breaks the
+    # pool) and yield (specimen_directory, job_status, started) as they complete; job_status is None for the jobs
+    # that were not finished when the pool broke, and started tells whether they were running at that time
+    with multiprocessing.Manager() as manager, \
+            ProcessPoolExecutor(max_workers=workers, initializer=limit_memory, initargs=(max_memory_gb,)) as executor:
+        started_jobs = manager.dict()
+        futures = {}
+        for specimen_directory in specimen_directories:
+            config = dict(base_config)
+            config['home_directory'] = specimen_directory
+            futures[executor.submit(run_started_job, config, started_jobs)] = specimen_directory
+        for future in as_completed(futures):
+            specimen_directory = futures[future]
+            try:
+                job_status = future.result()
+            except BrokenProcessPool:
+                job_status = None
+            yield specimen_directory, job_status, specimen_directory in started_jobs
+
+
+def run_isolated_jobs(specimen_directories, base_config, workers, max_memory_gb):
+    # As run_jobs, but every job runs alone in a pool of its own (up to workers of these pools at a time), so that a
+    # worker that dies only fails its own job
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(lambda specimen_directory: next(run_jobs([specimen_directory], base_config, 1,
+                                                                            max_memory_gb)), specimen_directory)
+                   for specimen_directory in specimen_directories]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+def batch_register(specimens, base_config, workers=1, max_memory_gb=None, retries=1, report_path=None):
+    # Register every specimen directory (list of directories or glob patterns) with the same base_config (which holds
+    # the shared target_coord_path) over a process pool
+    # max_memory_gb: address space limit of each job; failed jobs are retried up to retries times
+    # A per-job status and timing report is written to report_path (default: registration_report.json)
+    if report_path is None:
+        report_path = os.path.abspath('registration_report.json')
+    if max_memory_gb is not None and base_config.get('out_of_core'):
+        # RLIMIT_AS limits the address space, not the resident memory: memory-mapped volumes count in full
+        print("WARNING: the memory limit per job is not applied with out_of_core (memory-mapped volumes count "
+              "against the address space limit)")
+        max_memory_gb = None
+    specimen_directories = find_specimen_directories(specimens)
+    print(len(specimen_directories), ' specimen directories found')
+    start_time = time.perf_counter()
+
+    attempts = {specimen_directory: 0 for specimen_directory in specimen_directories}
+    # Number of times a job was running when its pool broke
+    suspicions = {specimen_directory: 0 for specimen_directory in specimen_directories}
+    job_statuses = {}
+    queue = list(specimen_directories)
+    isolated = []
+    while queue or isolated:
+        if queue:
+            is_shared_pool = len(queue) > 1
+            results = run_jobs(queue, base_config, workers, max_memory_gb)
+            queue = []
+        else:
+            is_shared_pool = False
+            results = run_isolated_jobs(isolated, base_config, workers, max_memory_gb)
+            isolated = []
+        not_started = []
+        suspects = []
+        for specimen_directory, job_status, started in results:
+            if job_status is None and is_shared_pool:
+                # A broken pool fails every unfinished job, not only the one whose worker died, so the attempt is not
+                # counted. Jobs that had not started and jobs running at a first break go back to a shared pool
+                # (the running ones last, away from each other); jobs running at a second break are run alone
+                if not started:
+                    not_started.append(specimen_directory)
+                    continue
+                suspicions[specimen_directory] += 1
+                if suspicions[specimen_directory] >= 2:
+                    isolated.append(specimen_directory)
+                else:
+                    suspects.append(specimen_directory)
+                continue
+            attempts[specimen_directory] += 1
+            if job_status is None:
+                job_status = {'home_directory': specimen_directory, 'status': 'failed',
+                              'error': 'worker process died (e.g. out of memory)'}
+            job_status['attempts'] = attempts[specimen_directory]
+            job_statuses[specimen_directory] = job_status
+            if job_status['status'] == 'failed' and attempts[specimen_directory] <= retries:
+                print('\tRetrying ', specimen_directory, ': ', job_status['error'])
+                queue.append(specimen_directory)
+            else:
+                print('\t', job_status['status'].upper(), ' ', specimen_directory, ' (',
+                      round(job_status.get('seconds', 0.0), 1), 's)', flush=True)
+                for flag in job_status.get('quality_flags', []):
+                    print('\t\tFlagged for review: ', flag)
+        queue = not_started + queue + suspects
+
+    jobs = [job_statuses[specimen_directory] for specimen_directory in specimen_directories]
+    summary = {
+        'n_jobs': len(jobs),
+        'n_done': sum(job['status'] == 'done' for job in jobs),
+        'n_failed': sum(job['status'] == 'failed' for job in jobs),
+        'n_flagged': sum(bool(job.get('quality_flags')) for job in jobs),
+        'seconds': time.perf_counter() - start_time,
+    }
+    write_report(report_path, {'summary': summary, 'config': base_config, 'jobs': jobs})
+    print('Registered ', summary['n_done'], ' specimens, ', summary['n_failed'], ' failed, ', summary['n_flagged'],
+          ' flagged for review, in ', round(summary['seconds'], 1), 's. Report: ', report_path)
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Register many specimen directories onto shared target coordinates')
+    parser.add_argument('specimens', nargs='+', help='specimen directories or glob patterns')
+    parser.add_argument('-t', '--target-coord', required=True, help='csv file of the target coordinates')
+    parser.add_argument('-c', '--config', default=None, help='json file with further registration parameters')
+    parser.add_argument('-w', '--workers', type=int, default=1, help='number of specimens registered in parallel')
+    parser.add_argument('--threads', type=int, default=1, help='resampling threads per specimen')
+    parser.add_argument('--max-memory-gb', type=float, default=None,
+                        help='address space limit per job (not applied with out_of_core, whose memory-mapped '
+                             'volumes count against it)')
+    parser.add_argument('--retries', type=int, default=1, help='number of retries of failed jobs')
+    parser.add_argument('--report', default=None, help='path of the json report')
+    parser.add_argument('--stage-cache', default=None,
+                        help='cache the stage results of all specimens in this directory (one shared size limit)')
+    args = parser.parse_args()
+    base_config = {}
+    if args.config is not None:
+        with open(args.config, 'r') as f:
+            base_config = json.load(f)
+    base_config['target_coord_path'] = os.path.abspath(args.target_coord)
+    base_config.setdefault('n_workers', args.threads)
+    if args.stage_cache is not None:
+        base_config['use_stage_cache'] = True
+        base_config['stage_cache_directory'] = os.path.abspath(args.stage_cache)
+    summary = batch_register(args.specimens, base_config, workers=args.workers, max_memory_gb=args.max_memory_gb,
+                             retries=args.retries, report_path=args.report)
+    return 1 if summary['n_failed'] else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,292 @@
+import argparse
+import contextlib
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+from scipy import ndimage as ndi
+from instrumentation import stage, configure_instrumentation
+from utility import downsample, scale_image, get_transform_matrix, linear_transform_image, composed_transform_image, \
+    tps_transform_image, save_image, linear_transform_swc, tps_transform_swc
+from iv2swc import iv2swc
+from swc_io import read_swc
+
+# Benchmark sizes: ZYX volume shape (2 channels) and neuron tree (depth, branching, points per filament)
+SIZES = {
+    'tiny': {'shape': (16, 64, 64), 'tree': (5, 2, 8)},
+    'small': {'shape': (32, 128, 128), 'tree': (8, 2, 8)},
+    'medium': {'shape': (64, 256, 256), 'tree': (11, 2, 8)},
+    'large': {'shape': (128, 512, 512), 'tree': (14, 2, 8)},
+}
+# Raw pixel size (ZYX, um) of the synthetic volumes
+PIXEL_SIZE = np.array([0.5, 0.2, 0.2])
+N_LANDMARKS = 12
+# Relative difference of result statistics above which a result no longer matches the baseline
+RESULT_RTOL = 1e-4
+# Modules whose cold start (import in a fresh interpreter) is timed with --startup: the light coordinate tools, and the
+# image pipeline for comparison
+STARTUP_MODULES = ('coordinates', 'transforms', 'iv2swc', 'coord_tools', 'utility', 'registration')
+
+
+def make_volume(shape, n_channels=2, dtype=np.uint16, seed=0):
+    # Synthetic ZYXC volume: smooth random structures (upsampled coarse noise) plus pixel noise
+    rng = np.random.default_rng(seed)
+    volume = np.empty(tuple(shape) + (n_channels,), dtype=dtype)
+    coarse_shape = [max(2, size // 8) for size in shape]
+    max_value = np.iinfo(dtype).max if np.issubdtype(dtype, np.integer) else 1.0
+    for channel in range(n_channels):
+        coarse = rng.random(coarse_shape)
+        smooth = ndi.zoom(coarse, [size / coarse_size for size, coarse_size in zip(shape, coarse_shape)], order=1)
+        smooth = smooth[:shape[0], :shape[1], :shape[2]] ** 4 + 0.05 * rng.random(shape)
+        volume[..., channel] = (smooth / smooth.max() * max_value).astype(dtype)
+    return volume
+
+
+def make_landmarks(shape, n_landmarks=N_LANDMARKS, jitter=1.5, seed=0):
+    # Random control landmarks (ZYX pixels) inside the volume, and target landmarks obtained from them by a random
+    # near-identity affine transformation plus a random (non-linear) jitter
+    rng = np.random.default_rng(seed)
+    shape = np.asarray(shape, dtype=np.float64)
+    control_coord = rng.uniform(0.15, 0.85, (n_landmarks, 3)) * (shape - 1)
+    matrix = np.eye(3) + rng.normal(0, 0.03, (3, 3))
+    centre = (shape - 1) / 2
+    target_coord = (control_coord - centre) @ matrix.T + centre + rng.normal(0, 0.02, 3) * shape
+    target_coord += rng.normal(0, jitter, target_coord.shape)
+    return control_coord, target_coord
+
+
+def make_tree(depth, branching, n_points, extent, seed=0):
+    # Random neuron tree as a list of filaments ((n_points, 3) XYZ um coordinates) in breadth-first order; every child
+    # filament starts at the last point of its parent, as in traces exported to iv
+    rng = np.random.default_rng(seed)
+    extent = np.asarray(extent, dtype=np.float64)
+    step = extent.min() / (4 * n_points)
+    filaments = []
+    parents = [np.round(extent * 0.5, 3)]
+    for _ in range(depth):
+        children = []
+        for start in parents:
+            for _ in range(branching if filaments else 1):
+                walk = start + np.cumsum(rng.normal(0, step, (n_points - 1, 3)), axis=0)
+                walk = np.clip(walk, 0, extent)
+                filament = np.vstack([start, np.round(walk, 3)])
+                filaments.append(filament)
+                children.append(filament[-1])
+        parents = children
+    return filaments
+
+
+def write_iv(iv_file_path, filaments):
+    # Write filaments in the Open Inventor layout read by iv2swc
+    with open(iv_file_path, 'w') as f:
+        f.write('#Inventor V2.1 ascii\n\nSeparator {\n')
+        for filament in filaments:
+            f.write('  Separator {\n    Coordinate3 {\n      point [ ')
+            f.write(',\n        '.join(' '.join('%g' % value for value in point) for point in filament))
+            f.write(' ]\n    }\n    LineSet { numVertices [ %d ] }\n  }\n' % len(filament))
+        f.write('}\n')
+    return iv_file_path
+
+
+def summarize_result(result):
+    # Statistics of a benchmark result used to check it against the baseline: arrays and swc files are reduced to
+    # their shape, mean and standard deviation
+    if isinstance(result, tuple):
+        result = result[0]
+    if isinstance(result, str) and result.endswith('.swc'):
+        result, _ = read_swc(result)
+    if isinstance(result, str):
+        return {'bytes': os.path.getsize(result)}
+    result = np.asarray(result)
+    return {'shape': list(result.shape), 'mean': float(np.mean(result, dtype=np.float64)),
+            'std': float(np.std(result, dtype=np.float64))}
+
+
+def results_match(summary, baseline_summary):
+    if summary.keys() != baseline_summary.keys():
+        return False
+    for key, value in summary.items():
+        baseline_value = baseline_summary[key]
+        if key in ('shape', 'bytes'):
+            if value != baseline_value:
+                return False
+        elif not np.isclose(value, baseline_value, rtol=RESULT_RTOL, atol=RESULT_RTOL):
+            return False
+    return True
+
+
+def time_function(benchmark_name, function, repeats):
+    # Best wall/CPU time and largest peak RSS over repeats; the (noisy) progress prints of the pipeline are silenced
+    timing = None
+    for _ in range(repeats):
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            with stage(benchmark_name) as record:
+                result = function()
+                record['outputs'] = [result]
+        if timing is None or record['wall_seconds'] < timing['wall_seconds']:
+            timing = {'wall_seconds': record['wall_seconds'], 'cpu_seconds': record['cpu_seconds'],
+                      'peak_rss_mb': max(record['peak_rss_mb'] or 0, (timing or {}).get('peak_rss_mb') or 0)}
+    timing['result'] = summarize_result(result)
+    return result, timing
+
+
+def run_size(size_name, work_directory, repeats=3, workers=1, benchmarks=None):
+    # Time every benchmark of one size on freshly generated synthetic data: {benchmark_name: timing}
+    shape = SIZES[size_name]['shape']
+    depth, branching, n_points = SIZES[size_name]['tree']
+    image = make_volume(shape)
+    control_coord, target_coord = make_landmarks(shape)
+    filaments = make_tree(depth, branching, n_points, np.array(shape[::-1]) * PIXEL_SIZE[::-1])
+    iv_file_path = write_iv(os.path.join(work_directory, size_name + '.iv'), filaments)
+    scaled_pixel_size = [PIXEL_SIZE[2]] * 3
+    swc_file_path = iv_file_path[:-3] + '.swc'
+    results = {}
+
+    def run(benchmark_name, function):
+        # Benchmarks that are not selected still run once (silenced), as they provide the inputs of later ones
+        if benchmarks is not None and benchmark_name not in benchmarks:
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                return function()
+        result, results[benchmark_name] = time_function(size_name + '/' + benchmark_name, function, repeats)
+        print('\t', f'{benchmark_name:<28}', f'{results[benchmark_name]["wall_seconds"]:10.4f} s')
+        return result
+
+    run('iv2swc', lambda: iv2swc(iv_file_path))
+    run('read_swc', lambda: read_swc(swc_file_path))
+    image_binned = run('downsample', lambda: downsample(image, 2))
+    image_scaled, _ = run('scale_image', lambda: scale_image(image_binned, PIXEL_SIZE * 2, workers=workers))
+    # Landmarks in the pixels of the scaled image
+    control_pixels = control_coord * (np.array(image_scaled.shape[0:3]) - 1) / (np.array(shape) - 1)
+    target_pixels = target_coord * (np.array(image_scaled.shape[0:3]) - 1) / (np.array(shape) - 1)
+    transform_matrix = run('get_transform_matrix',
+                           lambda: get_transform_matrix(control_pixels, target_pixels, 'affine'))
+    run('linear_transform_image', lambda: linear_transform_image(image_scaled, transform_matrix, workers=workers))
+    image_LT, _ = run('composed_transform_image',
+                      lambda: composed_transform_image(image, PIXEL_SIZE, transform_matrix, bin_factor=2,
+                                                       workers=workers))
+    run('tps_transform_image', lambda: tps_transform_image(image_LT, control_pixels, target_pixels,
+                                                           workers=workers)[0])
+    run('tps_transform_image_grid', lambda: tps_transform_image(image_LT, control_pixels, target_pixels,
+                                                                grid_spacing=8, workers=workers)[0])
+    run('save_image', lambda: save_image(os.path.join(work_directory, size_name + '.tif'), image_LT))
+    transformed_swc_path = os.path.join(work_directory, size_name + '_transformed.swc')
+    run('linear_transform_swc', lambda: linear_transform_swc(swc_file_path, transform_matrix, scaled_pixel_size,
+                                                             transformed_swc_path))
+    run('tps_transform_swc', lambda: tps_transform_swc(swc_file_path, control_pixels, target_pixels,
+                                                       scaled_pixel_size, transformed_swc_path))
+    return results
+
+
+def time_startup(module_name, repeats):
+    # Best wall and CPU time of importing module_name in a fresh python process (interpreter start included)
+    timing = None
+    for _ in range(repeats):
+        cpu_start = os.times()
+        wall_start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', 'import ' + module_name], check=True,
+                       cwd=os.path.dirname(os.path.abspath(__file__)))
+        wall_seconds = time.perf_counter() - wall_start
+        cpu_end = os.times()
+        cpu_seconds = cpu_end.children_user + cpu_end.children_system - cpu_start.children_user - \
+            cpu_start.children_system
+        if timing is None or wall_seconds < timing['wall_seconds']:
+            timing = {'wall_seconds': wall_seconds, 'cpu_seconds': cpu_seconds, 'peak_rss_mb': None, 'result': {}}
+    return timing
+
+
+def run_startup(repeats=3, benchmarks=None):
+    # Cold start time of the STARTUP_MODULES: {'import <module>': timing}
+    results = {}
+    for module_name in STARTUP_MODULES:
+        benchmark_name = 'import ' + module_name
+        if benchmarks is None or benchmark_name in benchmarks:
+            results[benchmark_name] = time_startup(module_name, repeats)
+            print('\t', f'{benchmark_name:<28}', f'{results[benchmark_name]["wall_seconds"]:10.4f} s')
+    return results
+
+
+def get_environment():
+    return {'python': platform.python_version(), 'numpy': np.__version__, 'machine': platform.machine(),
+            'processor': platform.processor(), 'cpu_count': os.cpu_count(), 'platform': platform.platform()}
+
+
+def compare_to_baseline(results, baseline, tolerance=0.2, min_seconds=0.01):
+    # Print the speedup of every benchmark against the baseline; returns the list of regressions (slower by more than
+    # tolerance, or results that differ from the baseline). Benchmarks faster than min_seconds are too noisy to flag.
+    regressions = []
+    print(f'{"benchmark":<40} {"baseline [s]":>12} {"current [s]":>12} {"speedup":>8}  result')
+    for size_name, size_results in results.items():
+        for benchmark_name, timing in size_results.items():
+            baseline_timing = baseline['results'].get(size_name, {}).get(benchmark_name)
+            if baseline_timing is None:
+                continue
+            speedup = baseline_timing['wall_seconds'] / max(timing['wall_seconds'], 1e-9)
+            matches = results_match(timing['result'], baseline_timing['result'])
+            name = size_name + '/' + benchmark_name
+            print(f'{name:<40} {baseline_timing["wall_seconds"]:>12.4f} {timing["wall_seconds"]:>12.4f} '
+                  f'{speedup:>7.2f}x  {"ok" if matches else "DIFFERS"}')
+            if speedup < 1 / (1 + tolerance) and timing['wall_seconds'] >= min_seconds:
+                regressions.append(name + ' is ' + f'{1 / speedup:.2f}' + 'x slower')
+            if not matches:
+                regressions.append(name + ' result differs from the baseline')
+    return regressions
+
+
+def run_benchmarks(size_names, repeats=3, workers=1, benchmarks=None, startup=False):
+    # Run the benchmarks for every size on synthetic data in a temporary directory: {size_name: {benchmark: timing}}
+    # startup: also time the cold start of the modules (reported as the size 'startup')
+    work_directory = tempfile.mkdtemp(prefix='registration_benchmark_')
+    results = {}
+    if startup:
+        print('Benchmarking the cold start of the modules')
+        results['startup'] = run_startup(repeats, benchmarks)
+    try:
+        for size_name in size_names:
+            print('Benchmarking size ', size_name, ' ', SIZES[size_name]['shape'])
+            results[size_name] = run_size(size_name, work_directory, repeats, workers, benchmarks)
+    finally:
+        shutil.rmtree(work_directory, ignore_errors=True)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the registration pipeline on synthetic volumes and traces')
+    parser.add_argument('--sizes', nargs='+', default=['tiny', 'small'], choices=list(SIZES),
+                        help='sizes of the synthetic data to sweep')
+    parser.add_argument('--benchmarks', nargs='+', default=None, help='run only these benchmarks')
+    parser.add_argument('--repeats', type=int, default=3, help='runs per benchmark (the fastest is kept)')
+    parser.add_argument('--workers', type=int, default=1, help='threads used by the image stages')
+    parser.add_argument('--output', default=None, help='write the results to this json file')
+    parser.add_argument('--save-baseline', default=None, help='store the results as a baseline json file')
+    parser.add_argument('--compare', default=None, help='compare the results against this baseline json file')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed relative slowdown against the baseline')
+    parser.add_argument('--startup', action='store_true', help='also time the cold start (imports) of the modules')
+    parser.add_argument('--min-seconds', type=float, default=0.01, help='do not flag slowdowns of faster benchmarks')
+    args = parser.parse_args()
+
+    # Progress messages are silenced; the peak RSS is reset per benchmark (this process only runs the benchmarks)
+    configure_instrumentation('WARNING', reset_peak_rss=True)
+    results = run_benchmarks(args.sizes, args.repeats, args.workers, args.benchmarks, args.startup)
+    report = {'environment': get_environment(), 'repeats': args.repeats, 'workers': args.workers,
+              'results': results}
+    for output_path in (args.output, args.save_baseline):
+        if output_path is not None:
+            with open(output_path, 'w') as f:
+                json.dump(report, f, indent=1)
+    if args.compare is not None:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+        regressions = compare_to_baseline(results, baseline, args.tolerance, args.min_seconds)
+        for regression in regressions:
+            print('REGRESSION: ', regression)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
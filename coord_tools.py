@@ -0,0 +1,89 @@
+import time
+# Start of the imports, so that --timing includes them
+IMPORT_START_TIME = time.perf_counter()
+import argparse
+import os
+import numpy as np
+from coordinates import read_coord_csv, write_coord_csv, um_to_pixel, pixel_to_um
+from transforms import load_transform, transform_swc_files
+from iv2swc import iv2swc
+from instrumentation import configure_instrumentation
+
+# Coordinate-only command line tools: iv to swc conversion and application of saved registrations to swc and landmark
+# files. Only numpy is imported (no scipy, tifffile or napari), so one call per file from a batch job starts quickly.
+
+
+def get_output_path(file_path, output_directory, suffix):
+    # <output_directory or the directory of file_path>/<name><suffix><extension>
+    name, extension = os.path.splitext(os.path.basename(file_path))
+    directory = os.path.dirname(os.path.abspath(file_path)) if output_directory is None else output_directory
+    return os.path.join(directory, name + suffix + extension)
+
+
+def load_registration(transform_path, inverse=False):
+    # Saved registration (see transforms.save_transform) and the pixel size its pixel coordinates refer to
+    transform, metadata = load_transform(transform_path)
+    if inverse:
+        transform = transform.inverse()
+    return transform, np.asarray(metadata['pixel_size'])
+
+
+def transform_csv_files(transform, csv_file_paths, pixel_size, output_directory=None, suffix='_transformed'):
+    # Apply a transformation to landmark csv files (XYZ um, as read by read_coord_csv)
+    transformed_csv_paths = []
+    for csv_file_path in csv_file_paths:
+        coord_pixels = um_to_pixel(read_coord_csv(csv_file_path), pixel_size)
+        transformed_csv_path = get_output_path(csv_file_path, output_directory, suffix)
+        write_coord_csv(transformed_csv_path, pixel_to_um(transform.apply(coord_pixels), pixel_size))
+        print('Writing ', transformed_csv_path)
+        transformed_csv_paths.append(transformed_csv_path)
+    return transformed_csv_paths
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Convert traces and apply saved registrations to traces and '
+                                                 'landmarks, without loading the image processing libraries')
+    parser.add_argument('--timing', action='store_true', help='print the time spent in the command')
+    parser.add_argument('--log-level', default='INFO',
+                        help="progress and stage timing messages: 'DEBUG', 'INFO' or 'WARNING' (silent)")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    iv_parser = subparsers.add_parser('iv2swc', help='convert iv files to swc files (written next to them)')
+    iv_parser.add_argument('iv_files', nargs='+')
+    for command, help_text in (('swc', 'transform swc files'), ('csv', 'transform landmark csv files (XYZ, um)')):
+        command_parser = subparsers.add_parser(command, help=help_text)
+        command_parser.add_argument('transform', help='registration_transform.json written by register_specimen')
+        command_parser.add_argument('files', nargs='+')
+        command_parser.add_argument('-o', '--output-directory', default=None,
+                                    help='directory of the transformed files (default: next to the inputs)')
+        command_parser.add_argument('--suffix', default='_transformed', help='appended to the transformed file names')
+        command_parser.add_argument('--inverse', action='store_true',
+                                    help='map from the target back onto the specimen')
+        if command == 'swc':
+            command_parser.add_argument('-w', '--workers', type=int, default=1, help='files transformed in parallel')
+    args = parser.parse_args(argv)
+    configure_instrumentation(args.log_level)
+
+    if args.command == 'iv2swc':
+        for iv_file_path in args.iv_files:
+            iv2swc(iv_file_path)
+    else:
+        transform, pixel_size = load_registration(args.transform, args.inverse)
+        if args.output_directory is not None:
+            os.makedirs(args.output_directory, exist_ok=True)
+        if args.command == 'swc':
+            # Files grouped by output directory (by default their own directory)
+            swc_file_paths = {}
+            for swc_file_path in args.files:
+                output_directory = args.output_directory or os.path.dirname(os.path.abspath(swc_file_path))
+                swc_file_paths.setdefault(output_directory, []).append(swc_file_path)
+            for output_directory, paths in swc_file_paths.items():
+                transform_swc_files(transform, paths, pixel_size, output_directory, args.suffix, workers=args.workers)
+        else:
+            transform_csv_files(transform, args.files, pixel_size, args.output_directory, args.suffix)
+    if args.timing:
+        print('Done in ', round(time.perf_counter() - IMPORT_START_TIME, 3), ' s (including the imports)')
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
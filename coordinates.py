@@ -0,0 +1,171 @@
+import csv
+import os
+import numpy as np
+from swc_io import read_swc, write_swc, get_sections
+from instrumentation import instrumented, logger
+from point_transform import evaluate_tps, evaluate_affine
+
+# Coordinate, landmark and swc operations. Only numpy is imported at module load, so that converters and point
+# transforms start quickly; the volume processing is in utility.
+
+
+def make_directory(new_directory_path):
+    is_exists = os.path.exists(new_directory_path)
+    if not is_exists:
+        os.mkdir(new_directory_path)
+        logger.info('%s is created', new_directory_path)
+    else:
+        logger.info('%s already exists', new_directory_path)
+
+
+def find_files(home_directory, file_extension):
+    file_found = 0
+    for file in os.listdir(home_directory):
+        if file.endswith(file_extension):
+            file_found = file_found + 1
+            file_name = file
+            logger.info('%s file found: %s', file_extension, file_name)
+            file_path = os.path.join(home_directory, file_name)
+    if file_found == 0:
+        logger.warning('%s file not found in %s', file_extension, home_directory)
+        file_path = None
+    return file_path
+
+
+def get_pixel_size(ics_path):
+    with open(ics_path, "r", encoding="utf-8") as f:
+        reader = csv.reader(f, delimiter="\t")
+        ics = list(reader)
+    pixel_size_x = float(ics[13][3])
+    pixel_size_y = float(ics[13][4])
+    pixel_size_z = float(ics[13][5])
+    pixel_size = [pixel_size_z, pixel_size_y, pixel_size_x]
+    return np.array(pixel_size)
+
+
+def um_to_pixel(um_data, pixel_size):
+    pixel_data = np.zeros_like(um_data)
+    pixel_data[:, 0] = um_data[:, 0] / pixel_size[0]
+    pixel_data[:, 1] = um_data[:, 1] / pixel_size[1]
+    pixel_data[:, 2] = um_data[:, 2] / pixel_size[2]
+    return pixel_data
+
+
+def pixel_to_um(pixel_data, pixel_size):
+    um_data = np.zeros_like(pixel_data)
+    um_data[:, 0] = pixel_data[:, 0] * pixel_size[0]
+    um_data[:, 1] = pixel_data[:, 1] * pixel_size[1]
+    um_data[:, 2] = pixel_data[:, 2] * pixel_size[2]
+    return um_data
+
+
+def get_axon_dendrite_for_napari(swc_path, pixel_size, use_cache=False):
+    swc_data, _ = read_swc(swc_path, use_cache=use_cache)
+    axon = []
+    dendrite = []
+    for section_type, coord in get_sections(swc_data):
+        coord = um_to_pixel(coord, pixel_size)
+        coord = np.flip(coord, axis=1)
+        if section_type == 2:
+            axon.append(coord)
+        elif section_type == 3:
+            dendrite.append(coord)
+    return axon, dendrite
+
+
+def read_coord_csv(csv_path):
+    with open(csv_path, "r", encoding="utf-8-sig") as f:
+        reader = csv.reader(f, delimiter=",")
+        csv_data = list(reader)
+    # Get rid of the last column data
+    csv_data = np.array(csv_data)
+    csv_data = csv_data[:, 0:3]
+    csv_data = np.array(csv_data, dtype=float)
+    # Re-order the axis to zyx
+    csv_data = np.flip(csv_data, axis=1)
+    return csv_data
+
+
+def write_coord_csv(csv_path, csv_data):
+    csv_data = np.flip(csv_data, axis=1)
+    with open(csv_path, 'w', newline='') as f:
+        writer = csv.writer(f, delimiter=",")
+        writer.writerows(csv_data)
+
+
+@instrumented
+def get_transform_matrix(control_coord, target_coord, transform_type):
+    from transforms3d._gohlketransforms import affine_matrix_from_points
+    logger.info('Calculating the transformation matrix...')
+    if transform_type == "affine":
+        transform_matrix = affine_matrix_from_points(target_coord.T, control_coord.T)
+    elif transform_type == "rigid":
+        transform_matrix = affine_matrix_from_points(target_coord.T, control_coord.T, shear=False, scale=False)
+    else:
+        logger.error('Unknown transform_type (must be affine or rigid)')
+    return transform_matrix
+
+
+@instrumented
+def linear_transform_coord(coord, transform_matrix, workers=1):
+    logger.info('Performing linear transformation of the given coordinates based on the transformation matrix...')
+    # Applied block by block, without a homogeneous copy of the coordinates
+    transformed_coord = evaluate_affine(coord, transform_matrix, workers=workers)
+    return transformed_coord
+
+
+def transform_swc(swc_file_path, transform_fun, pixel_size, transformed_swc_path, use_cache=False):
+    # Apply transform_fun (pixel ZYX coordinates (N, 3) -> transformed pixel ZYX coordinates) to the neurite
+    # coordinates of a swc file and save the result as a new swc file
+    # Read the neurite coordinates
+    swc_data, header = read_swc(swc_file_path, use_cache=use_cache)
+    # extract only the coordinates part
+    swc_coord = swc_data[:, 2:5]
+    # Convert to ZYX format for processing
+    swc_coord = np.flip(swc_coord, axis=1)
+    # Convert to pixel unit
+    swc_coord = um_to_pixel(swc_coord, pixel_size)
+    # Perform transformation
+    swc_coord_transformed = transform_fun(swc_coord)
+    # Convert it back to um unit
+    swc_coord_transformed = pixel_to_um(swc_coord_transformed, pixel_size)
+    # Convert it back to XYZ format for saving
+    swc_coord_transformed = np.flip(swc_coord_transformed, axis=1)
+    # Put it back to the swc_data
+    swc_data = swc_data.copy()
+    swc_data[:, 2:5] = swc_coord_transformed
+    # Save the result as a swc file
+    logger.info('Writing %s', transformed_swc_path)
+    write_swc(transformed_swc_path, swc_data, header)
+    return transformed_swc_path
+
+
+@instrumented
+def linear_transform_swc(swc_file_path, transform_matrix, pixel_size, transformed_swc_path, use_cache=False):
+    logger.info('Performing linear transformation of the given neurite data based on the transformation matrix...')
+    transform_swc(swc_file_path, lambda coord: linear_transform_coord(coord, transform_matrix), pixel_size,
+                  transformed_swc_path, use_cache=use_cache)
+    return transformed_swc_path
+
+
+def _evaluate_spline(tps_fun, coord, workers=1, dtype=np.float64):
+    # Fitted splines (ThinPlateSpline or transforms.TpsTransform) are evaluated block by block by evaluate_tps, which
+    # keeps the kernel matrix of a block only; other maps (e.g. composed transforms) are applied as they are
+    if hasattr(tps_fun, 'parameters'):
+        return evaluate_tps(coord, tps_fun.control_points, tps_fun.parameters, dtype=dtype, workers=workers)
+    return tps_fun.transform(coord)
+
+
+@instrumented
+def tps_transform_swc(swc_file_path, control_coord, target_coord, pixel_size, transformed_swc_path, use_cache=False,
+                      tps_fun=None, workers=1):
+    # tps_fun: already fitted map from control to target coordinates (e.g. a transforms.TpsTransform)
+    # workers: threads transforming blocks of neurite points
+    logger.info('Performing TPS transformation of the given neurite data based on the tps object...')
+    if tps_fun is None:
+        from tps import ThinPlateSpline
+        tps_fun = ThinPlateSpline(0.5)
+        tps_fun.fit(control_coord, target_coord)
+    transform_swc(swc_file_path, lambda coord: _evaluate_spline(tps_fun, coord, workers), pixel_size,
+                  transformed_swc_path, use_cache=use_cache)
+    return transformed_swc_path
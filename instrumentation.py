@@ -0,0 +1,195 @@
+import contextlib
+import functools
+import json
+import logging
+import sys
+import time
+import numpy as np
+
+# Stage timings and memory use are reported through this logger: stage starts at DEBUG, stage results at INFO
+logger = logging.getLogger('registration')
+
+MB = 1024 ** 2
+# Records of the finished stages of this process, and the stack of the running (nested) stages
+_records = []
+_running_stages = []
+_settings = {'jsonl_path': None, 'handler': None, 'reset_peak_rss': False}
+
+
+def configure_instrumentation(level='INFO', jsonl_path=None, stream=None, reset_peak_rss=False):
+    # Show the progress and stage log messages of the given level on stream (default: sys.stdout), and append every
+    # stage record as a json line to jsonl_path (if given)
+    # reset_peak_rss: reset the peak RSS of the process at the start of every stage (linux, see _reset_peak_rss)
+    if _settings['handler'] is not None:
+        logger.removeHandler(_settings['handler'])
+    handler = logging.StreamHandler(sys.stdout if stream is None else stream)
+    handler.setFormatter(logging.Formatter('%(levelname)s %(message)s'))
+    logger.addHandler(handler)
+    logger.setLevel(level)
+    logger.propagate = False
+    _settings['handler'] = handler
+    _settings['jsonl_path'] = jsonl_path
+    _settings['reset_peak_rss'] = reset_peak_rss
+
+
+def reset_records():
+    _records.clear()
+
+
+def get_records():
+    return list(_records)
+
+
+def _read_proc_status(key):
+    # Value in bytes of a memory entry (VmRSS, VmHWM) of /proc/self/status; None where /proc is not available
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith(key + ':'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def _reset_peak_rss():
+    # Reset the peak RSS (VmHWM) of the process so that the next reading is the peak of the stage only (linux)
+    # This resets the peak for every reader of /proc/<pid>/status, and needs write access to /proc/self/clear_refs
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _get_peak_rss():
+    peak_rss = _read_proc_status('VmHWM')
+    if peak_rss is None:
+        try:
+            import resource
+        except ImportError:
+            return None
+        # Peak of the whole process lifetime; kilobytes on linux, bytes on macOS
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        peak_rss *= 1 if sys.platform == 'darwin' else 1024
+    return peak_rss
+
+
+def _to_mb(n_bytes):
+    return None if n_bytes is None else round(n_bytes / MB, 3)
+
+
+def get_array_info(values):
+    # Shapes, dtypes and total size in MB of the numpy arrays among values and the tuples in values (e.g. the results
+    # of stages returning (image, pixel_size))
+    arrays = []
+    for value in values:
+        if isinstance(value, np.ndarray):
+            arrays.append(value)
+        elif isinstance(value, tuple):
+            arrays.extend(item for item in value if isinstance(item, np.ndarray))
+    return {'shapes': [list(array.shape) for array in arrays], 'dtypes': [str(array.dtype) for array in arrays],
+            'mb': _to_mb(sum(array.nbytes for array in arrays))}
+
+
+@contextlib.contextmanager
+def stage(stage_name, inputs=()):
+    # Record wall time, CPU time (all threads), RSS and peak RSS of the enclosed code, and the sizes of the input
+    # arrays. The yielded record can be given the outputs (record['outputs'] = ...) before the block ends.
+    # The peak RSS is read without resetting it: peak_rss_mb is the peak of the process so far, peak_rss_increase_mb
+    # how much the stage raised it. With configure_instrumentation(reset_peak_rss=True) the peak is reset at the
+    # start of the stage (where permitted), and peak_rss_mb is the peak of the stage itself
+    record = {'stage': stage_name, 'parent': _running_stages[-1]['stage'] if _running_stages else None,
+              'depth': len(_running_stages), 'inputs': get_array_info(inputs)}
+    record['_peak_rss_exact'] = False
+    if _settings['reset_peak_rss']:
+        if _running_stages:
+            # The peak of the parent stage so far would be lost by the reset below
+            parent = _running_stages[-1]
+            parent['_peak_rss'] = max(parent['_peak_rss'] or 0, _get_peak_rss() or 0)
+        record['_peak_rss_exact'] = _reset_peak_rss()
+    record['_peak_rss'] = None
+    rss_start = _read_proc_status('VmRSS')
+    peak_rss_start = _get_peak_rss()
+    _running_stages.append(record)
+    logger.debug('Starting stage %s', stage_name)
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    status = 'done'
+    try:
+        yield record
+    except BaseException:
+        status = 'failed'
+        raise
+    finally:
+        wall_seconds = time.perf_counter() - wall_start
+        cpu_seconds = time.process_time() - cpu_start
+        _running_stages.pop()
+        rss_end = _read_proc_status('VmRSS')
+        peak_rss = max(record.pop('_peak_rss') or 0, _get_peak_rss() or 0) or None
+        peak_rss_exact = record.pop('_peak_rss_exact')
+        if _running_stages:
+            parent = _running_stages[-1]
+            parent['_peak_rss'] = max(parent['_peak_rss'] or 0, peak_rss or 0)
+        record.update({
+            'status': status,
+            'wall_seconds': round(wall_seconds, 6),
+            'cpu_seconds': round(cpu_seconds, 6),
+            'rss_start_mb': _to_mb(rss_start),
+            'rss_end_mb': _to_mb(rss_end),
+            # Without a peak reset this is the peak of the whole process so far
+            'peak_rss_mb': _to_mb(peak_rss),
+            'peak_rss_increase_mb': _to_mb(None if peak_rss is None or peak_rss_start is None
+                                           else max(peak_rss - peak_rss_start, 0)),
+            'peak_rss_is_stage_peak': peak_rss_exact,
+            'time': time.time(),
+        })
+        record['outputs'] = get_array_info(record.get('outputs', ()))
+        _records.append(record)
+        _write_record(record)
+        logger.info('%s%s: %s in %.3f s (CPU %.3f s), peak RSS %s MB (+%s MB), in %s MB, out %s MB',
+                    '  ' * record['depth'], stage_name, status, wall_seconds, cpu_seconds, record['peak_rss_mb'],
+                    record['peak_rss_increase_mb'], record['inputs']['mb'], record['outputs']['mb'])
+
+
+def _write_record(record):
+    if _settings['jsonl_path'] is not None:
+        with open(_settings['jsonl_path'], 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+
+def instrumented(function):
+    # Decorator recording every call of a pipeline stage function (see stage); the stage is named after the function
+    @functools.wraps(function)
+    def instrumented_function(*args, **kwargs):
+        with stage(function.__name__, inputs=list(args) + list(kwargs.values())) as record:
+            result = function(*args, **kwargs)
+            record['outputs'] = [result]
+        return result
+    return instrumented_function
+
+
+def get_stage_totals(records=None):
+    # Total wall time, CPU time and largest peak RSS per stage name: {stage: {calls, wall_seconds, ...}}
+    totals = {}
+    for record in _records if records is None else records:
+        total = totals.setdefault(record['stage'], {'calls': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0,
+                                                    'peak_rss_mb': None})
+        total['calls'] += 1
+        total['wall_seconds'] += record['wall_seconds']
+        total['cpu_seconds'] += record['cpu_seconds']
+        if record['peak_rss_mb'] is not None:
+            total['peak_rss_mb'] = max(total['peak_rss_mb'] or 0, record['peak_rss_mb'])
+    return totals
+
+
+def format_summary_table(records=None):
+    # Text table of get_stage_totals, slowest stage first
+    totals = get_stage_totals(records)
+    lines = [f'{"stage":<36} {"calls":>6} {"wall [s]":>10} {"CPU [s]":>10} {"peak RSS [MB]":>14}']
+    for stage_name, total in sorted(totals.items(), key=lambda item: -item[1]['wall_seconds']):
+        peak_rss = '' if total['peak_rss_mb'] is None else f'{total["peak_rss_mb"]:.1f}'
+        lines.append(f'{stage_name:<36} {total["calls"]:>6} {total["wall_seconds"]:>10.3f} '
+                     f'{total["cpu_seconds"]:>10.3f} {peak_rss:>14}')
+    return '\n'.join(lines)
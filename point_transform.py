@@ -0,0 +1,84 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+# Points transformed at a time: the temporary kernel matrices are (POINT_BLOCK_SIZE, n_control), whatever the number
+# of points
+POINT_BLOCK_SIZE = 8192
+
+
+def tps_kernel(distances, n_dims=3, order=2):
+    # Radial basis function of the polyharmonic spline fitted by tps.ThinPlateSpline (r in 3D, r^2 log r in 2D),
+    # computed in place
+    power = 2 * order - n_dims
+    if power <= 0:
+        power = 2
+    if power == 1:
+        return distances
+    if power % 2:
+        return np.power(distances, power, out=distances)
+    distances[distances == 0] = 1
+    return np.multiply(distances ** power, np.log(distances), out=distances)
+
+
+def _map_blocks(function, n_points, block_size, workers):
+    # Call function(start, stop) on consecutive blocks of points, on a thread pool if workers > 1 (None: all cores)
+    blocks = [(start, min(start + block_size, n_points)) for start in range(0, n_points, block_size)]
+    workers = (os.cpu_count() or 1) if workers is None else max(1, int(workers))
+    if workers == 1 or len(blocks) == 1:
+        for block in blocks:
+            function(*block)
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(lambda block: function(*block), blocks))
+
+
+def evaluate_tps(coord, control_points, parameters, block_size=POINT_BLOCK_SIZE, dtype=np.float64, workers=1,
+                 output=None):
+    # Evaluate a fitted spline f(x) = sum_i w_i G(|x - c_i|) + C @ [1, x] (parameters = [W; C] as in ThinPlateSpline)
+    # at (N, D) points, block by block so that memory use does not grow with N
+    # dtype: float32 roughly halves memory and time at ~1e-3 pixel accuracy; the computation is centred on the control
+    #   points to keep float32 rounding small. output: optional (N, D) array to write into (default: new array of dtype)
+    coord = np.asarray(coord)
+    control_points = np.asarray(control_points, dtype=np.float64)
+    parameters = np.asarray(parameters, dtype=np.float64)
+    n_control, n_dims = control_points.shape
+    centre = control_points.mean(axis=0)
+    centred_control = (control_points - centre).astype(dtype)
+    weights = parameters[:n_control].astype(dtype)
+    linear = parameters[n_control + 1:].astype(dtype)
+    # Constant term of the polynomial in centred coordinates
+    constant = (parameters[n_control] + centre @ parameters[n_control + 1:]).astype(dtype)
+    if output is None:
+        output = np.empty((len(coord), parameters.shape[1]), dtype=dtype)
+
+    def evaluate_block(start, stop):
+        centred = np.asarray(coord[start:stop], dtype=np.float64) - centre
+        centred = centred.astype(dtype, copy=False)
+        # Squared distances accumulated axis by axis: only two (block, n_control) temporaries
+        distances = np.zeros((stop - start, n_control), dtype=dtype)
+        for axis in range(n_dims):
+            difference = np.subtract.outer(centred[:, axis], centred_control[:, axis])
+            distances += np.square(difference, out=difference)
+        kernel = tps_kernel(np.sqrt(distances, out=distances), n_dims)
+        output[start:stop] = kernel @ weights + centred @ linear + constant
+
+    _map_blocks(evaluate_block, len(coord), block_size, workers)
+    return output
+
+
+def evaluate_affine(coord, matrix, block_size=POINT_BLOCK_SIZE, dtype=np.float64, workers=1, output=None):
+    # Apply a homogeneous (D + 1, D + 1) matrix to (N, D) points block by block (no homogeneous copy of the points)
+    coord = np.asarray(coord)
+    matrix = np.asarray(matrix, dtype=np.float64)
+    n_dims = matrix.shape[0] - 1
+    linear = matrix[:n_dims, :n_dims].T.astype(dtype)
+    translation = matrix[:n_dims, n_dims].astype(dtype)
+    if output is None:
+        output = np.empty((len(coord), n_dims), dtype=dtype)
+
+    def evaluate_block(start, stop):
+        output[start:stop] = np.asarray(coord[start:stop], dtype=dtype) @ linear + translation
+
+    _map_blocks(evaluate_block, len(coord), block_size, workers)
+    return output
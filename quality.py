@@ -0,0 +1,171 @@
+import numpy as np
+from instrumentation import instrumented, logger
+from utility import _tps_displacement_grid, get_intensity_range
+from transforms import AffineTransform, TpsTransform, TPS_ALPHA
+
+# Metrics above (or, for the similarities, below) these values flag a registration for review; None disables a check.
+# Landmark errors are in um; folding_fraction is the fraction of the deformation field with a Jacobian determinant <= 0
+DEFAULT_QUALITY_THRESHOLDS = {
+    'landmark_rms_um': 5.0,
+    'leave_one_out_rms_um': 15.0,
+    'leave_one_out_max_um': 40.0,
+    'folding_fraction': 0.0,
+    'min_ncc': None,
+    'min_mutual_information': None,
+}
+
+
+def get_error_summary(errors):
+    # Mean, RMS and maximum of per-landmark error distances, and the landmark with the largest error
+    errors = np.asarray(errors, dtype=np.float64)
+    return {'mean': float(errors.mean()), 'rms': float(np.sqrt(np.mean(errors ** 2))), 'max': float(errors.max()),
+            'worst_landmark': int(errors.argmax()), 'errors': errors.tolist()}
+
+
+def landmark_residuals(transform, source_coord, target_coord, pixel_size):
+    # Distance (um) between the transformed source landmarks and the target landmarks; coordinates in ZYX pixels
+    residuals = (transform.apply(source_coord) - np.asarray(target_coord)) * np.asarray(pixel_size)
+    return np.linalg.norm(residuals, axis=1)
+
+
+def leave_one_out_errors(source_coord, target_coord, pixel_size, transform_type='affine', do_tps=True,
+                         alpha=TPS_ALPHA):
+    # Error (um) at each landmark of the registration refitted without it (linear transformation, then TPS): how well
+    # the transformation predicts landmarks it was not fitted on. Residuals of the full fit are small by construction.
+    source_coord = np.asarray(source_coord, dtype=np.float64)
+    target_coord = np.asarray(target_coord, dtype=np.float64)
+    errors = np.empty(len(source_coord))
+    for landmark in range(len(source_coord)):
+        kept = np.arange(len(source_coord)) != landmark
+        linear_transform = AffineTransform.fit(source_coord[kept], target_coord[kept], transform_type)
+        predicted = linear_transform.apply(source_coord[[landmark]])
+        if do_tps:
+            tps_transform = TpsTransform.fit(linear_transform.apply(source_coord[kept]), target_coord[kept], alpha)
+            predicted = tps_transform.apply(predicted)
+        errors[landmark] = np.linalg.norm((predicted[0] - target_coord[landmark]) * np.asarray(pixel_size))
+    return errors
+
+
+def _derivative(values, axis, spacing):
+    # Finite difference derivative along an axis (zero along axes of a single lattice node)
+    if values.shape[axis] < 2:
+        return np.zeros_like(values)
+    return np.gradient(values, spacing, axis=axis)
+
+
+def jacobian_determinant(transform, shape, grid_spacing=8, block_planes=16):
+    # Jacobian determinant of a map from output to input indices (e.g. the pull-back of a TPS warp) on a lattice with
+    # nodes every grid_spacing voxels of an output volume of the given shape; values <= 0 mean that the warp folds
+    # The displacement field is evaluated as in the grid mode of tps_transform_image and differentiated by finite
+    # differences, block_planes lattice planes at a time. Shape of the result: the lattice shape
+    displacement_grid = _tps_displacement_grid(transform, shape, grid_spacing)
+    grid_shape = displacement_grid.shape[1:]
+    determinant = np.empty(grid_shape)
+    for z_start in range(0, grid_shape[0], block_planes):
+        z_stop = min(z_start + block_planes, grid_shape[0])
+        # One lattice plane of overlap on each side, so that the z derivative is central inside the volume
+        z_low, z_high = max(z_start - 1, 0), min(z_stop + 1, grid_shape[0])
+        block = displacement_grid[:, z_low:z_high]
+        # jacobian[i][j]: derivative of input index i with respect to output index j
+        jacobian = [[_derivative(block[i], j, grid_spacing)[z_start - z_low:z_stop - z_low] + (i == j)
+                     for j in range(3)] for i in range(3)]
+        determinant[z_start:z_stop] = (
+            jacobian[0][0] * (jacobian[1][1] * jacobian[2][2] - jacobian[1][2] * jacobian[2][1])
+            - jacobian[0][1] * (jacobian[1][0] * jacobian[2][2] - jacobian[1][2] * jacobian[2][0])
+            + jacobian[0][2] * (jacobian[1][0] * jacobian[2][1] - jacobian[1][1] * jacobian[2][0]))
+    return determinant
+
+
+def get_jacobian_summary(determinant):
+    return {'min': float(determinant.min()), 'max': float(determinant.max()), 'mean': float(determinant.mean()),
+            'folding_fraction': float(np.mean(determinant <= 0))}
+
+
+def image_similarity(image, reference, bins=64, block_planes=16):
+    # Normalized cross-correlation and mutual information (nats, from a bins x bins joint histogram) between every
+    # channel of two ZYXC volumes of the same shape, accumulated block_planes z-planes at a time
+    # Returns {'ncc': [per channel], 'mutual_information': [per channel]}
+    if image.shape[0:3] != reference.shape[0:3]:
+        raise ValueError('Volumes of different shapes ' + str(image.shape) + ' and ' + str(reference.shape))
+    ranges = [get_intensity_range(volume, block_planes) for volume in (image, reference)]
+    n_channels = min(image.shape[3], reference.shape[3])
+    # Per channel: count, sums, sums of squares and of products, and the joint histogram
+    sums = np.zeros((n_channels, 6))
+    joint_histograms = np.zeros((n_channels, bins * bins), dtype=np.int64)
+
+    def to_bins(block, value_range):
+        data_min, data_max = (float(value) for value in value_range)
+        scale = bins / (data_max - data_min) if data_max > data_min else 0.0
+        return np.clip(((block - data_min) * scale).astype(np.int64), 0, bins - 1)
+
+    for z_start in range(0, image.shape[0], block_planes):
+        block = np.asarray(image[z_start:z_start + block_planes], dtype=np.float64).reshape(-1, image.shape[3])
+        reference_block = np.asarray(reference[z_start:z_start + block_planes],
+                                     dtype=np.float64).reshape(-1, reference.shape[3])
+        for channel in range(n_channels):
+            a, b = block[:, channel], reference_block[:, channel]
+            sums[channel] += [len(a), a.sum(), b.sum(), a @ a, b @ b, a @ b]
+            joint_histograms[channel] += np.bincount(to_bins(a, ranges[0]) * bins + to_bins(b, ranges[1]),
+                                                     minlength=bins * bins)
+
+    similarity = {'ncc': [], 'mutual_information': []}
+    for channel in range(n_channels):
+        n, sum_a, sum_b, sum_aa, sum_bb, sum_ab = sums[channel]
+        covariance = sum_ab - sum_a * sum_b / n
+        variance = (sum_aa - sum_a ** 2 / n) * (sum_bb - sum_b ** 2 / n)
+        similarity['ncc'].append(float(covariance / np.sqrt(variance)) if variance > 0 else 0.0)
+        joint = joint_histograms[channel].reshape(bins, bins) / n
+        marginals = np.outer(joint.sum(axis=1), joint.sum(axis=0))
+        nonzero = joint > 0
+        similarity['mutual_information'].append(float(np.sum(joint[nonzero] *
+                                                             np.log(joint[nonzero] / marginals[nonzero]))))
+    return similarity
+
+
+def flag_registration(quality, thresholds=None):
+    # Reasons for reviewing a registration: the metrics of evaluate_registration beyond the thresholds
+    thresholds = dict(DEFAULT_QUALITY_THRESHOLDS, **(thresholds or {}))
+    checks = [
+        ('landmark_rms_um', quality['landmark_error']['rms'], False),
+        ('leave_one_out_rms_um', quality['leave_one_out_error']['rms'], False),
+        ('leave_one_out_max_um', quality['leave_one_out_error']['max'], False),
+    ]
+    if quality.get('jacobian') is not None:
+        checks.append(('folding_fraction', quality['jacobian']['folding_fraction'], False))
+    if quality.get('similarity') is not None:
+        checks.append(('min_ncc', min(quality['similarity']['ncc']), True))
+        checks.append(('min_mutual_information', min(quality['similarity']['mutual_information']), True))
+    flags = []
+    for name, value, lower_is_worse in checks:
+        threshold = thresholds.get(name)
+        if threshold is not None and (value < threshold if lower_is_worse else value > threshold):
+            flags.append(f'{name} = {value:.4g} ({"<" if lower_is_worse else ">"} {threshold})')
+    return flags
+
+
+@instrumented
+def evaluate_registration(transform, control_coord, target_coord, pixel_size, transform_type='affine', do_tps=True,
+                          image_shape=None, image_transform=None, grid_spacing=8, image=None, reference=None,
+                          thresholds=None):
+    # Quality metrics of a registration of control_coord onto target_coord (ZYX pixels of size pixel_size):
+    # - landmark_error: residuals (um) of the fitted transform
+    # - leave_one_out_error: errors (um) of the registration refitted without each landmark
+    # - jacobian: determinant of image_transform (output to input indices of the warp, e.g. the inverse TPS) on a
+    #   lattice over image_shape (if both are given)
+    # - similarity: NCC and mutual information of the warped image against a reference volume (if both are given)
+    # - flags: reasons for reviewing the registration (see flag_registration)
+    logger.info('Evaluating the registration quality...')
+    quality = {
+        'landmark_error': get_error_summary(landmark_residuals(transform, control_coord, target_coord, pixel_size)),
+        'leave_one_out_error': get_error_summary(leave_one_out_errors(control_coord, target_coord, pixel_size,
+                                                                      transform_type, do_tps)),
+        'jacobian': None,
+        'similarity': None,
+    }
+    if image_transform is not None and image_shape is not None:
+        quality['jacobian'] = get_jacobian_summary(jacobian_determinant(image_transform, image_shape[0:3],
+                                                                        grid_spacing))
+    if image is not None and reference is not None:
+        quality['similarity'] = image_similarity(image, reference)
+    quality['flags'] = flag_registration(quality, thresholds)
+    return quality
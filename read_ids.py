@@ -1,9 +1,105 @@
-import javabridge
-import bioformats
+import gzip
+import numpy as np
+from instrumentation import instrumented, logger
 
+# Axis names used by the ics layout order, mapped to the ZYXC axes of the returned image
+ICS_AXES = {'z': 'z', 'y': 'y', 'x': 'x', 'ch': 'c', 'c': 'c'}
+
+
+def read_ics_header(ics_path):
+    # Parse the tab separated key/value lines of an ics header into a dictionary {(category, key): [values]}
+    # Reading stops at the 'end' line (ics version 2 files store the pixel data after it, at the returned offset)
+    header = {}
+    data_offset = None
+    with open(ics_path, 'rb') as f:
+        # First line holds the separators (field, line)
+        f.readline()
+        while True:
+            line = f.readline()
+            if not line:
+                break
+            fields = line.decode('latin-1').rstrip('\r\n').split('\t')
+            if fields[0] == 'end':
+                data_offset = f.tell()
+                break
+            if len(fields) >= 2:
+                header[(fields[0], fields[1])] = fields[2:]
+            elif len(fields) == 1 and fields[0]:
+                header[(fields[0], '')] = []
+    return header, data_offset
+
+
+def get_ids_layout(header):
+    # Axis names, sizes (fastest axis first) and numpy dtype of the pixel data described by an ics header
+    order = header[('layout', 'order')]
+    sizes = [int(size) for size in header[('layout', 'sizes')]]
+    bits = sizes[order.index('bits')]
+    axes = [axis for axis in order if axis != 'bits']
+    axis_sizes = [size for axis, size in zip(order, sizes) if axis != 'bits']
+
+    data_format = header.get(('representation', 'format'), ['integer'])[0]
+    sign = header.get(('representation', 'sign'), ['unsigned'])[0]
+    if data_format == 'real':
+        kind = 'f'
+    elif sign == 'signed':
+        kind = 'i'
+    else:
+        kind = 'u'
+    # byte_order lists the significance of the bytes in file order: '1 2 ...' is little endian
+    byte_order = header.get(('representation', 'byte_order'), ['1'])
+    endian = '>' if len(byte_order) > 1 and int(byte_order[0]) > int(byte_order[-1]) else '<'
+    dtype = np.dtype(endian + kind + str(bits // 8))
+    compression = header.get(('representation', 'compression'), ['uncompressed'])[0]
+    return axes, axis_sizes, dtype, compression
+
+
+def read_ids_native(ids_path):
+    # Read an ics/ids image pair without Bio-Formats
+    # The ids pixel data is memory-mapped in its native dtype and returned as a ZYXC view (no copy); gzip compressed
+    # data is decompressed into memory
+    ics_path = ids_path[:-4] + '.ics'
+    header, data_offset = read_ics_header(ics_path)
+    axes, axis_sizes, dtype, compression = get_ids_layout(header)
+    for axis, size in zip(axes, axis_sizes):
+        if axis not in ICS_AXES and size > 1:
+            raise ValueError('Unsupported ics axis ' + axis + ' with size ' + str(size))
+
+    # Version 2 ics files hold the pixel data themselves, after the header
+    ics_version = next((key[1] for key in header if key[0] == 'ics_version'), '1.0')
+    if ics_version.startswith('2') and data_offset is not None:
+        data_path, offset = ics_path, data_offset
+    else:
+        data_path, offset = ids_path, 0
+    n_values = int(np.prod(axis_sizes))
+    # The first axis of the layout is the fastest varying one, so the C-order shape is the reversed layout
+    shape = tuple(reversed(axis_sizes))
+    if compression == 'uncompressed':
+        data = np.memmap(data_path, dtype=dtype, mode='r', offset=offset, shape=shape)
+    elif compression == 'gzip':
+        with open(data_path, 'rb') as f:
+            f.seek(offset)
+            data = np.frombuffer(gzip.decompress(f.read()), dtype=dtype, count=n_values).reshape(shape)
+    else:
+        raise ValueError('Unsupported ids compression ' + compression)
+
+    # Drop singleton axes we do not use, add missing ZYXC axes and order them as ZYXC
+    reversed_axes = [ICS_AXES.get(axis, axis) for axis in reversed(axes)]
+    index = tuple(slice(None) if axis in ICS_AXES.values() else 0 for axis in reversed_axes)
+    data = data[index]
+    reversed_axes = [axis for axis in reversed_axes if axis in ICS_AXES.values()]
+    for axis in 'zyxc':
+        if axis not in reversed_axes:
+            data = data[..., np.newaxis]
+            reversed_axes.append(axis)
+    return data.transpose([reversed_axes.index(axis) for axis in 'zyxc'])
+
+
+def read_ids_bioformats(ids_path, dtype=np.float64):
+    # Read an ids file through Bio-Formats (requires python-bioformats and python-javabridge)
+    # dtype: dtype of the returned image (the planes are rescaled floats; np.float32 halves the memory)
+    import javabridge
+    import bioformats
 
-def read_ids(ids_path):
-    print('Reading ', ids_path, '...', end="", flush=True)
     # Start the Java virtual machine
     javabridge.start_vm(class_path=bioformats.JARS)
 
@@ -13,7 +109,7 @@ def read_ids(ids_path):
     pixels = o.image().Pixels
 
     # Initialize array: image will be saved in zyxc format (Scikit image convention)
-    result_array = np.empty([pixels.SizeZ, pixels.SizeY, pixels.SizeX, pixels.SizeC])
+    result_array = np.empty([pixels.SizeZ, pixels.SizeY, pixels.SizeX, pixels.SizeC], dtype=dtype)
 
     # Import data
     for ch in range(0, pixels.SizeC):
@@ -22,5 +118,19 @@ def read_ids(ids_path):
             result_array[pln, :, :, ch] = img
     # Terminate the Java virtual machine
     javabridge.kill_vm()
-    print("[DONE]")
-    return result_array
\ No newline at end of file
+    return result_array
+
+
+@instrumented
+def read_ids(ids_path, use_bioformats=False):
+    # Read an ids image as ZYXC; the native reader is used unless use_bioformats (or the header cannot be handled)
+    logger.info('Reading %s...', ids_path)
+    result_array = None
+    if not use_bioformats:
+        try:
+            result_array = read_ids_native(ids_path)
+        except (OSError, KeyError, ValueError) as error:
+            logger.warning('native ids reader failed (%s), falling back to Bio-Formats', error)
+    if result_array is None:
+        result_array = read_ids_bioformats(ids_path)
+    return result_array
@@ -0,0 +1,352 @@
+import json
+import os
+from utility import find_files, get_pixel_size, scale_image, read_coord_csv, um_to_pixel, \
+    linear_transform_image, linear_transform_coord, linear_transform_swc, make_directory, pixel_to_um, \
+    write_coord_csv, downsample, tps_transform_image, tps_transform_swc, save_image, composed_transform_image, \
+    read_tif, build_pyramid, level_transform_image
+from iv2swc import iv2swc
+from stage_cache import StageCache, file_signature
+from transforms import AffineTransform, TpsTransform, CompositeTransform, save_transform
+from quality import evaluate_registration
+from instrumentation import configure_instrumentation, reset_records, get_records, stage, logger, \
+    format_summary_table
+
+# Parameters of a registration run; see main2.py for their meaning
+DEFAULT_CONFIG = {
+    'home_directory': None,
+    'target_coord_path': None,
+    'transform_type': 'affine',
+    'do_tps': True,
+    'tps_grid_spacing': None,
+    'image_bin_factor': 2,
+    'fuse_resampling': True,
+    'align_target_coord': True,
+    'n_workers': None,
+    'use_swc_cache': True,
+    'use_stage_cache': False,
+    'stage_cache_directory': None,
+    'stage_cache_max_size_gb': 50.0,
+    'image_compression': None,
+    'out_of_core': False,
+    'pyramid_levels': 0,
+    'preview_level': None,
+    'log_level': 'INFO',
+    'stage_metrics': True,
+    'reset_peak_rss': False,
+    'precision': 'float64',
+    'evaluate_quality': True,
+    'reference_image_path': None,
+    'quality_thresholds': None,
+}
+
+
+def get_config(config):
+    # Complete a (partial) registration config with the default values
+    unknown_keys = set(config) - set(DEFAULT_CONFIG)
+    if unknown_keys:
+        raise ValueError('Unknown registration parameters: ' + ', '.join(sorted(unknown_keys)))
+    full_config = dict(DEFAULT_CONFIG)
+    full_config.update(config)
+    for key in ('home_directory', 'target_coord_path'):
+        if full_config[key] is None:
+            raise ValueError(key + ' must be given')
+    if full_config['precision'] not in ('float64', 'float32'):
+        raise ValueError('Unknown precision ' + str(full_config['precision']) + ' (must be float64 or float32)')
+    preview_level = full_config['preview_level']
+    if preview_level is not None and not 0 <= preview_level <= full_config['pyramid_levels']:
+        raise ValueError('preview_level ' + str(preview_level) + ' is not a level of the pyramid (0 to '
+                         'pyramid_levels = ' + str(full_config['pyramid_levels']) + ')')
+    return full_config
+
+
+def register_specimen(config):
+    # Register the image volume and the neuron traces of one specimen directory onto the target coordinates
+    # config: dictionary of registration parameters (see DEFAULT_CONFIG), at least home_directory and
+    # target_coord_path. All results are written to <home_directory>/transformed_results; the returned dictionary
+    # holds the in-memory results, the paths of the written files and the timing/memory records of every stage
+    config = get_config(config)
+    # Create a directory to save all the transformed results
+    transformed_results_dir = os.path.join(config['home_directory'], 'transformed_results')
+    make_directory(transformed_results_dir)
+    # Stage records are appended to stage_metrics.jsonl, so that runs on growing volumes can be compared
+    stage_metrics_path = os.path.join(transformed_results_dir, 'stage_metrics.jsonl') if config['stage_metrics'] \
+        else None
+    configure_instrumentation(config['log_level'], stage_metrics_path, reset_peak_rss=config['reset_peak_rss'])
+    reset_records()
+    with stage('register_specimen'):
+        results = _register_specimen(config, transformed_results_dir)
+    results['stage_records'] = get_records()
+    results['stage_metrics_path'] = stage_metrics_path
+    logger.info('Stage summary of %s:\n%s', config['home_directory'], format_summary_table())
+    return results
+
+
+def _register_specimen(config, transformed_results_dir):
+    home_directory = config['home_directory']
+    transform_type = config['transform_type']
+    image_bin_factor = config['image_bin_factor']
+    n_workers = config['n_workers']
+    use_swc_cache = config['use_swc_cache']
+    # dtype of the computed volumes; the raw image keeps its native dtype
+    dtype = config['precision']
+
+    ####################################################################################################################
+    # Data Loading and Preprocessing
+
+    # Directory for the on-disk (memory-mapped) volumes when processing out of core
+    if config['out_of_core']:
+        scratch_directory = os.path.join(transformed_results_dir, 'scratch')
+        make_directory(scratch_directory)
+    else:
+        scratch_directory = None
+    # Cache of stage results, keyed on hashes of their inputs and parameters; by default in the specimen directory, or
+    # shared by all specimens (with a single size limit) in stage_cache_directory
+    stage_cache_directory = config['stage_cache_directory'] or os.path.join(home_directory, 'stage_cache')
+    stage_cache = StageCache(stage_cache_directory if config['use_stage_cache'] else None,
+                             config['stage_cache_max_size_gb'])
+
+    # Find all the necessary files
+    ics_file_path = find_files(home_directory, '.ics')
+    csv_file_path = find_files(home_directory, '.csv')
+    iv_file_path = find_files(home_directory, '.iv')
+    swc_file_path = find_files(home_directory, '.swc')
+    ids_file_path = find_files(home_directory, '.ids')
+    tif_file_path = find_files(home_directory, '.tif')
+
+    # Read image file
+    # if tif does not exist, it will assume that ids exists, and will convert ids to tif and save
+    if tif_file_path is None:
+        from read_ids import read_ids
+        logger.info('Converting IDS to TIF ...')
+        # Native dtype, memory-mapped from the ids file
+        image = read_ids(ids_file_path)
+        stage_cache.register_input(image, file_signature(ids_file_path))
+        # Save the ids file as tif (ImageJ ZCYX, native dtype) so that later runs read the tif
+        save_image(ids_file_path[:-4] + '.tif', image, keep_dtype=True)
+        tif_file_path = find_files(home_directory, '.tif')
+    else:
+        # Read tif file (ZYXC); memory-mapped when processing out of core
+        image = read_tif(tif_file_path, use_memmap=config['out_of_core'])
+        # Key the raw image on its file instead of hashing its content
+        stage_cache.register_input(image, file_signature(tif_file_path))
+
+    # Get pixel size, and downsample if needed (Optional)
+    # Get pixel size
+    raw_pixel_size = get_pixel_size(ics_file_path)
+    # Scale pixel size by the downsample bin factor
+    pixel_size = raw_pixel_size * image_bin_factor
+    pyramid = None
+    pyramid_directory = None
+    if config['pyramid_levels']:
+        # Binned copies of the raw image (by 2, 4, ...) for previews and display, stored memory-mapped
+        pyramid_directory = os.path.join(transformed_results_dir, 'pyramid')
+        make_directory(pyramid_directory)
+        pyramid = build_pyramid(image, config['pyramid_levels'], pyramid_directory, dtype=dtype)
+    if config['fuse_resampling'] or pyramid is not None:
+        # Downsample and scaling are folded into the linear transformation below; only the resulting pixel size is
+        # needed
+        image_scaled = None
+        pixel_size = [pixel_size[2], pixel_size[2], pixel_size[2]]
+    else:
+        # Down sample the image
+        image_binned = stage_cache.run('downsample', downsample, image, image_bin_factor,
+                                       scratch_directory=scratch_directory, dtype=dtype)
+        # Scale the original image such that all axis have the save pixel size
+        image_scaled, pixel_size = stage_cache.run('scale_image', scale_image, image_binned, pixel_size,
+                                                   workers=n_workers, scratch_directory=scratch_directory)
+
+    # if swc file does not exist, convert iv to swc
+    if swc_file_path is None:
+        swc_file_path = iv2swc(iv_file_path)
+
+    # Read control and target coordinates in csv file, and convert both from um to pixels
+    control_coord = read_coord_csv(csv_file_path)
+    target_coord = read_coord_csv(config['target_coord_path'])
+    control_coord_pixels = um_to_pixel(control_coord, pixel_size)
+    target_coord_pixels = um_to_pixel(target_coord, pixel_size)
+
+    ####################################################################################################################
+    # Target coordinates alignment
+
+    if config['align_target_coord']:
+        # Rigid transformation moving the target coordinates onto the control coordinates
+        alignment_transform = AffineTransform.fit(target_coord_pixels, control_coord_pixels, 'rigid')
+        # Perform transformation
+        target_coord_pixels = linear_transform_coord(target_coord_pixels, alignment_transform.matrix)
+        # Save the new target coordinates results
+        target_coord = pixel_to_um(target_coord_pixels, pixel_size)
+        transformed_target_csv_file_path = os.path.join(transformed_results_dir, 'aligned_target_coord.csv')
+        write_coord_csv(transformed_target_csv_file_path, target_coord)
+
+    ####################################################################################################################
+    #   Linear Transformation
+
+    # Linear transformation of the specimen onto the target coordinates, fitted once: points are mapped with it,
+    # images are resampled with its exact inverse (output indices to input indices)
+    linear_transform = AffineTransform.fit(control_coord_pixels, target_coord_pixels, transform_type)
+    image_matrix = linear_transform.inverse().matrix
+
+    # Transforming image volumes
+    # Transform image data and save results
+    preview_level = None
+    preview_LT = None
+    preview_TPS = None
+    preview_pixel_size = None
+    if pyramid is not None:
+        # Quick look at the transformation, sampled from a coarse pyramid level
+        preview_level = len(pyramid) - 1 if config['preview_level'] is None else config['preview_level']
+        if preview_level >= len(pyramid):
+            # Binning stops once a side of the image is a single voxel
+            raise ValueError('preview_level ' + str(preview_level) + ' is not a level of the pyramid: the image only '
+                             'has ' + str(len(pyramid) - 1) + ' binned levels')
+        preview_LT, preview_pixel_size = level_transform_image(pyramid[preview_level], 2 ** preview_level, image.shape,
+                                                               raw_pixel_size, image_matrix, image_bin_factor,
+                                                               workers=n_workers)
+        save_image(os.path.join(transformed_results_dir, transform_type + '_preview_image.tif'), preview_LT)
+        # The full resolution image is read from the pyramid level matching the bin factor if there is one
+        level_factors = [2 ** level for level in range(len(pyramid))]
+        if image_bin_factor in level_factors:
+            image_level = pyramid[level_factors.index(image_bin_factor)]
+        else:
+            image_level = stage_cache.run('downsample', downsample, image, image_bin_factor,
+                                          scratch_directory=scratch_directory, dtype=dtype)
+    linear_transformed_image_path = None
+    if pyramid is not None and config['do_tps']:
+        # The linear and TPS transformations are applied together below, in a single full resolution pass
+        image_LT = None
+    elif pyramid is not None:
+        image_LT, _ = stage_cache.run('level_transform_image', level_transform_image, image_level, image_bin_factor,
+                                      image.shape, raw_pixel_size, image_matrix, image_bin_factor,
+                                      workers=n_workers, scratch_directory=scratch_directory)
+    elif config['fuse_resampling']:
+        image_LT, _ = stage_cache.run('composed_transform_image', composed_transform_image, image, raw_pixel_size,
+                                      image_matrix, bin_factor=image_bin_factor, workers=n_workers,
+                                      scratch_directory=scratch_directory, dtype=dtype)
+    else:
+        image_LT = stage_cache.run('linear_transform_image', linear_transform_image, image_scaled, image_matrix,
+                                   workers=n_workers, scratch_directory=scratch_directory)
+    if image_LT is not None:
+        linear_transformed_image_path = os.path.join(transformed_results_dir,
+                                                     transform_type + '_transformed_image.tif')
+        save_image(linear_transformed_image_path, image_LT, compression=config['image_compression'],
+                   workers=n_workers)
+
+    # Transforming coordinates
+    # Transform neurites data and save results
+    linear_transformed_swc_path = os.path.join(transformed_results_dir, transform_type + '_transformed_neurites.swc')
+    linear_transform_swc(swc_file_path, linear_transform.matrix, pixel_size, linear_transformed_swc_path,
+                         use_cache=use_swc_cache)
+
+    # Transform control coord data and save results
+    linear_transformed_control_coord_pixels = linear_transform_coord(control_coord_pixels, linear_transform.matrix)
+    linear_transformed_control_coord = pixel_to_um(linear_transformed_control_coord_pixels, pixel_size)
+    write_coord_csv(os.path.join(transformed_results_dir, transform_type + '_transformed_control_coord.csv'),
+                    linear_transformed_control_coord)
+
+    ####################################################################################################################
+    # Non-linear Transform (TPS)
+
+    image_TPS = None
+    tps_transformed_image_path = None
+    tps_transformed_swc_path = None
+    registration_transform = linear_transform
+    if config['do_tps']:
+        # Spline from the linearly transformed onto the target coordinates, fitted once; images are resampled with the
+        # spline fitted the other way round
+        tps_transform = TpsTransform.fit(linear_transformed_control_coord_pixels, target_coord_pixels)
+        registration_transform = CompositeTransform([linear_transform, tps_transform])
+    if config['do_tps'] and pyramid is not None:
+        preview_TPS, _ = level_transform_image(pyramid[preview_level], 2 ** preview_level, image.shape,
+                                               raw_pixel_size, image_matrix, image_bin_factor,
+                                               grid_spacing=config['tps_grid_spacing'], workers=n_workers,
+                                               tps_fun=tps_transform.inverse())
+        save_image(os.path.join(transformed_results_dir, 'tps_preview_image.tif'), preview_TPS)
+        # Composed linear and TPS transformation of the full resolution image in a single interpolation
+        image_TPS, _ = stage_cache.run('level_transform_image', level_transform_image, image_level, image_bin_factor,
+                                       image.shape, raw_pixel_size, image_matrix, image_bin_factor,
+                                       grid_spacing=config['tps_grid_spacing'], workers=n_workers,
+                                       scratch_directory=scratch_directory, tps_fun=tps_transform.inverse())
+    elif config['do_tps']:
+        # TPS transform the image
+        image_TPS, _ = stage_cache.run('tps_transform_image', tps_transform_image, image_LT, None, None,
+                                       grid_spacing=config['tps_grid_spacing'], workers=n_workers,
+                                       scratch_directory=scratch_directory, tps_fun=tps_transform.inverse())
+    if config['do_tps']:
+        tps_transformed_image_path = os.path.join(transformed_results_dir, 'tps' + '_transformed_image.tif')
+        save_image(tps_transformed_image_path, image_TPS, compression=config['image_compression'], workers=n_workers)
+        # TPS  transform the SWC
+        tps_transformed_swc_path = os.path.join(transformed_results_dir, 'tps' + '_transformed_neurites.swc')
+        tps_transform_swc(linear_transformed_swc_path, linear_transformed_control_coord_pixels, target_coord_pixels,
+                          pixel_size, tps_transformed_swc_path, use_cache=use_swc_cache, tps_fun=tps_transform,
+                          workers=n_workers)
+
+    ####################################################################################################################
+    # Registration quality
+
+    quality = None
+    quality_path = None
+    if config['evaluate_quality']:
+        quality = _evaluate_quality(config, registration_transform, control_coord_pixels, target_coord_pixels,
+                                    pixel_size, tps_transform.inverse() if config['do_tps'] else None,
+                                    image_TPS if config['do_tps'] else image_LT)
+        quality_path = os.path.join(transformed_results_dir, 'registration_quality.json')
+        with open(quality_path, 'w') as f:
+            json.dump(quality, f, indent=1)
+
+    # Save the fitted registration (specimen pixels onto target pixels), to apply it to further traces without refitting
+    transform_path = save_transform(os.path.join(transformed_results_dir, 'registration_transform.json'),
+                                    registration_transform, pixel_size=[float(size) for size in pixel_size],
+                                    transform_type=transform_type, home_directory=home_directory)
+
+    return {
+        'config': config,
+        'scratch_directory': scratch_directory,
+        'transformed_results_dir': transformed_results_dir,
+        'image': image,
+        'raw_pixel_size': raw_pixel_size,
+        'pixel_size': pixel_size,
+        'image_scaled': image_scaled,
+        'image_LT': image_LT,
+        'image_TPS': image_TPS,
+        'pyramid': pyramid,
+        'pyramid_directory': pyramid_directory,
+        'preview_level': preview_level,
+        'preview_LT': preview_LT,
+        'preview_TPS': preview_TPS,
+        'preview_pixel_size': preview_pixel_size,
+        'control_coord_pixels': control_coord_pixels,
+        'target_coord_pixels': target_coord_pixels,
+        'linear_transformed_control_coord_pixels': linear_transformed_control_coord_pixels,
+        'swc_file_path': swc_file_path,
+        'linear_transformed_swc_path': linear_transformed_swc_path,
+        'tps_transformed_swc_path': tps_transformed_swc_path,
+        'linear_transformed_image_path': linear_transformed_image_path,
+        'tps_transformed_image_path': tps_transformed_image_path,
+        'transform': registration_transform,
+        'transform_path': transform_path,
+        'quality': quality,
+        'quality_path': quality_path,
+    }
+
+
+def _evaluate_quality(config, registration_transform, control_coord_pixels, target_coord_pixels, pixel_size,
+                      image_transform, image_warped):
+    # Landmark errors, folding of the TPS warp and - if a reference volume is given - similarity of the warped image
+    reference = None
+    if config['reference_image_path'] is not None:
+        reference = read_tif(config['reference_image_path'], use_memmap=config['out_of_core'])
+        if image_warped is None or reference.shape[0:3] != image_warped.shape[0:3]:
+            logger.warning('the reference image %s does not match the shape of the transformed image, image '
+                           'similarity is not computed', config['reference_image_path'])
+            reference = None
+    quality = evaluate_registration(registration_transform, control_coord_pixels, target_coord_pixels, pixel_size,
+                                    config['transform_type'], config['do_tps'],
+                                    image_shape=None if image_warped is None else image_warped.shape,
+                                    image_transform=image_transform, grid_spacing=config['tps_grid_spacing'] or 8,
+                                    image=image_warped if reference is not None else None, reference=reference,
+                                    thresholds=config['quality_thresholds'])
+    logger.info('\tLandmark error (RMS): %.3f um, leave-one-out error (RMS): %.3f um',
+                quality['landmark_error']['rms'], quality['leave_one_out_error']['rms'])
+    for flag in quality['flags']:
+        logger.warning('registration flagged for review: %s', flag)
+    return quality
@@ -0,0 +1,184 @@
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import time
+import uuid
+import weakref
+import numpy as np
+from instrumentation import stage, logger
+
+# Bump to invalidate every cached result (e.g. after a change of the stage implementations)
+CACHE_VERSION = 1
+# Keyword arguments which change how a stage runs but not its result
+NON_KEY_ARGUMENTS = ('workers', 'max_memory_mb', 'output', 'scratch_directory')
+HASH_BLOCK_BYTES = 1 << 24
+
+
+def file_signature(file_path):
+    # Cheap stand-in for the content of an input file: path, size and modification time
+    stat = os.stat(file_path)
+    return {'path': os.path.abspath(file_path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+class StageCache:
+    # Content-addressed cache of pipeline stage results
+    # Each result is keyed on the stage name, the function and hashes of all its inputs and parameters. Arrays are
+    # stored as .npy files and loaded memory-mapped; other results are pickled. The least recently used entries are
+    # evicted when the cache grows over max_size_gb. With cache_directory=None every stage is simply recomputed.
+
+    def __init__(self, cache_directory, max_size_gb=50.0):
+        self.cache_directory = cache_directory
+        self.max_size_bytes = int(max_size_gb * 1024 ** 3)
+        # Digests of arrays returned by the cache (id -> (weak reference, digest)), so that results passed on to the
+        # next stage are keyed by their lineage instead of being hashed again
+        self._known_digests = {}
+        if cache_directory is not None:
+            os.makedirs(cache_directory, exist_ok=True)
+
+    def _array_digest(self, array):
+        known = self._known_digests.get(id(array))
+        if known is not None and known[0]() is array:
+            return known[1]
+        array = np.ascontiguousarray(array)
+        digest = hashlib.blake2b(digest_size=20)
+        digest.update(str(array.dtype).encode() + str(array.shape).encode())
+        flat = array.reshape(-1).view(np.uint8)
+        for block_start in range(0, flat.size, HASH_BLOCK_BYTES):
+            digest.update(flat[block_start:block_start + HASH_BLOCK_BYTES])
+        return digest.hexdigest()
+
+    def _update_digest(self, digest, value):
+        # Feed a stage input (arrays, scalars, strings and nested lists/tuples/dicts of them) into the digest
+        if isinstance(value, np.ndarray):
+            digest.update(b'array:' + self._array_digest(value).encode())
+        elif isinstance(value, (list, tuple)):
+            digest.update(b'sequence:' + str(len(value)).encode())
+            for item in value:
+                self._update_digest(digest, item)
+        elif isinstance(value, dict):
+            digest.update(b'dict:' + str(len(value)).encode())
+            for key in sorted(value, key=str):
+                self._update_digest(digest, str(key))
+                self._update_digest(digest, value[key])
+        elif hasattr(value, 'to_dict'):
+            # Fitted transformations (see transforms.py) are keyed on their parameters
+            self._update_digest(digest, value.to_dict())
+        elif isinstance(value, np.generic):
+            digest.update(b'scalar:' + str(value.dtype).encode() + value.tobytes())
+        else:
+            digest.update(b'value:' + repr(value).encode())
+
+    def register_input(self, array, *identity):
+        # Key an input array on a cheap identity (e.g. file_signature of the file it was read from) instead of hashing
+        # its content
+        digest = hashlib.blake2b(digest_size=20)
+        self._update_digest(digest, list(identity))
+        self._known_digests[id(array)] = (weakref.ref(array), 'input:' + digest.hexdigest())
+        return array
+
+    def get_key(self, stage_name, function, args, kwargs):
+        digest = hashlib.blake2b(digest_size=20)
+        self._update_digest(digest, [CACHE_VERSION, stage_name, function.__module__, function.__qualname__])
+        self._update_digest(digest, list(args))
+        self._update_digest(digest, {name: value for name, value in kwargs.items() if name not in NON_KEY_ARGUMENTS})
+        return stage_name + '-' + digest.hexdigest()
+
+    def _load(self, entry_directory):
+        with open(os.path.join(entry_directory, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+        items = []
+        for item_idx, kind in enumerate(meta['kinds']):
+            if kind == 'array':
+                items.append(np.load(os.path.join(entry_directory, f'item_{item_idx}.npy'), mmap_mode='r'))
+            else:
+                with open(os.path.join(entry_directory, f'item_{item_idx}.pkl'), 'rb') as f:
+                    items.append(pickle.load(f))
+        # Mark the entry as recently used
+        os.utime(os.path.join(entry_directory, 'meta.json'))
+        return tuple(items) if meta['is_tuple'] else items[0]
+
+    def _store(self, key, stage_name, result):
+        # Write into a temporary directory first so that interrupted runs never leave a partial entry behind
+        entry_directory = os.path.join(self.cache_directory, key)
+        temporary_directory = os.path.join(self.cache_directory, '.tmp-' + uuid.uuid4().hex)
+        os.makedirs(temporary_directory)
+        is_tuple = isinstance(result, tuple)
+        kinds = []
+        for item_idx, item in enumerate(result if is_tuple else (result,)):
+            if isinstance(item, np.ndarray):
+                np.save(os.path.join(temporary_directory, f'item_{item_idx}.npy'), item)
+                kinds.append('array')
+            else:
+                with open(os.path.join(temporary_directory, f'item_{item_idx}.pkl'), 'wb') as f:
+                    pickle.dump(item, f)
+                kinds.append('pickle')
+        with open(os.path.join(temporary_directory, 'meta.json'), 'w') as f:
+            json.dump({'stage': stage_name, 'is_tuple': is_tuple, 'kinds': kinds, 'created': time.time()}, f)
+        try:
+            os.replace(temporary_directory, entry_directory)
+        except OSError:
+            # Another run stored the same entry in the meantime
+            shutil.rmtree(temporary_directory, ignore_errors=True)
+
+    def _register_result(self, key, result):
+        items = result if isinstance(result, tuple) else (result,)
+        for item_idx, item in enumerate(items):
+            if isinstance(item, np.ndarray):
+                self._known_digests[id(item)] = (weakref.ref(item), key + f'/{item_idx}')
+
+    def run(self, stage_name, function, *args, **kwargs):
+        # Return function(*args, **kwargs), loading it from the cache if the same stage already ran on the same inputs
+        if self.cache_directory is None:
+            return function(*args, **kwargs)
+        key = self.get_key(stage_name, function, args, kwargs)
+        entry_directory = os.path.join(self.cache_directory, key)
+        is_cached = os.path.exists(os.path.join(entry_directory, 'meta.json'))
+        if is_cached:
+            logger.info('Loading cached result of stage %s', stage_name)
+            try:
+                with stage(stage_name + ' (cached)') as record:
+                    result = self._load(entry_directory)
+                    record['outputs'] = [result]
+            except FileNotFoundError:
+                # Evicted by another run sharing the cache directory in the meantime
+                is_cached = False
+        if not is_cached:
+            result = function(*args, **kwargs)
+            self._store(key, stage_name, result)
+            self.evict()
+        self._register_result(key, result)
+        return result
+
+    def get_size(self):
+        # Total size in bytes of every cache entry, and a list of (last use time, size, directory) per entry
+        entries = []
+        for entry_name in os.listdir(self.cache_directory):
+            entry_directory = os.path.join(self.cache_directory, entry_name)
+            meta_path = os.path.join(entry_directory, 'meta.json')
+            if entry_name.startswith('.tmp-') or not os.path.exists(meta_path):
+                continue
+            try:
+                size = sum(os.path.getsize(os.path.join(entry_directory, file_name))
+                           for file_name in os.listdir(entry_directory))
+                entries.append((os.path.getmtime(meta_path), size, entry_directory))
+            except FileNotFoundError:
+                # Evicted by another run sharing the cache directory
+                continue
+        return sum(entry[1] for entry in entries), entries
+
+    def evict(self):
+        # Remove the least recently used entries until the cache fits in max_size_gb
+        total_size, entries = self.get_size()
+        for _, size, entry_directory in sorted(entries):
+            if total_size <= self.max_size_bytes:
+                break
+            logger.info('Evicting cached result %s', os.path.basename(entry_directory))
+            shutil.rmtree(entry_directory, ignore_errors=True)
+            total_size -= size
+
+    def clear(self):
+        if self.cache_directory is not None:
+            shutil.rmtree(self.cache_directory, ignore_errors=True)
+            os.makedirs(self.cache_directory, exist_ok=True)
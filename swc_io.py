@@ -0,0 +1,103 @@
+import hashlib
+import os
+import re
+import numpy as np
+
+# Columns of an swc file: index, structure type, x, y, z, radius, parent index
+SWC_COLUMNS = 7
+SWC_FORMAT = ('%d', '%d', '%1.6f', '%1.6f', '%1.6f', '%1.1f', '%d')
+SWC_CACHE_SUFFIX = '.cache.npz'
+COMMENT_PATTERN = re.compile(rb'#[^\r\n]*')
+# Rows are formatted this many at a time by a single % operation
+WRITE_BLOCK_ROWS = 100000
+
+
+def parse_swc(swc_content):
+    # Parse the bytes content of an swc file into a (N, 7) float64 array and the list of its comment lines
+    header = [comment.decode('utf-8', errors='replace') for comment in COMMENT_PATTERN.findall(swc_content)]
+    if header:
+        swc_content = COMMENT_PATTERN.sub(b'', swc_content)
+    swc_data = np.fromstring(swc_content, sep=' ')
+    if swc_data.size % SWC_COLUMNS != 0:
+        raise ValueError('swc content does not have ' + str(SWC_COLUMNS) + ' values per row')
+    return swc_data.reshape((-1, SWC_COLUMNS)), header
+
+
+def get_cache_path(swc_file_path):
+    return swc_file_path + SWC_CACHE_SUFFIX
+
+
+def read_swc(swc_file_path, use_cache=False):
+    # Read an swc file into a (N, 7) float64 array and the list of its comment (header) lines
+    # use_cache: keep a parsed copy in an .npz sidecar keyed by the hash of the file content, so that rereading an
+    # unchanged file skips text parsing
+    with open(swc_file_path, 'rb') as f:
+        swc_content = f.read()
+    if not use_cache:
+        return parse_swc(swc_content)
+
+    content_hash = hashlib.sha256(swc_content).hexdigest()
+    cache_path = get_cache_path(swc_file_path)
+    if os.path.exists(cache_path):
+        with np.load(cache_path) as cache:
+            if str(cache['sha256']) == content_hash:
+                return cache['swc_data'], list(cache['header'])
+    swc_data, header = parse_swc(swc_content)
+    with open(cache_path, 'wb') as f:
+        np.savez(f, swc_data=swc_data, header=np.array(header, dtype=str), sha256=content_hash)
+    return swc_data, header
+
+
+def format_swc(swc_data, fmt=SWC_FORMAT):
+    # Format the rows of an swc array as text (identical to np.savetxt with the same fmt and a space delimiter)
+    row_format = ' '.join(fmt) + '\n'
+    swc_lines = []
+    for block_start in range(0, len(swc_data), WRITE_BLOCK_ROWS):
+        block = swc_data[block_start:block_start + WRITE_BLOCK_ROWS]
+        swc_lines.append(row_format * len(block) % tuple(block.ravel().tolist()))
+    return ''.join(swc_lines)
+
+
+def write_swc(swc_file_path, swc_data, header=None, fmt=SWC_FORMAT):
+    # Write an (N, 7) swc array, optionally preceded by comment lines
+    with open(swc_file_path, 'w') as f:
+        if header:
+            f.write(''.join(line + '\n' for line in header))
+        f.write(format_swc(np.asarray(swc_data), fmt))
+    return swc_file_path
+
+
+def get_sections(swc_data):
+    # Split the swc tree into unbranched sections; a section ends at branch points, leaves and structure type changes
+    # Returns a list of (structure type, (M, 3) xyz coordinates); non-root sections start with their parent point
+    node_ids = swc_data[:, 0].astype(np.int64)
+    node_types = swc_data[:, 1].astype(np.int64)
+    parent_ids = swc_data[:, 6].astype(np.int64)
+    id_to_row = {node_id: row for row, node_id in enumerate(node_ids.tolist())}
+    parent_rows = np.array([id_to_row.get(parent_id, -1) for parent_id in parent_ids.tolist()], dtype=np.int64)
+    n_children = np.bincount(parent_rows[parent_rows >= 0], minlength=len(swc_data))
+    # A node starts a new section if it is a root, its parent branches, or its type differs from its parent
+    has_parent = parent_rows >= 0
+    starts_section = ~has_parent
+    starts_section[has_parent] = (n_children[parent_rows[has_parent]] != 1) | \
+                                 (node_types[has_parent] != node_types[parent_rows[has_parent]])
+    # Follow the single child of each node until the section ends
+    only_child = np.full(len(swc_data), -1, dtype=np.int64)
+    child_rows = np.nonzero(has_parent)[0]
+    only_child[parent_rows[child_rows]] = child_rows
+    only_child[n_children != 1] = -1
+
+    sections = []
+    for row in np.nonzero(starts_section)[0].tolist():
+        section_rows = [parent_rows[row]] if parent_rows[row] >= 0 else []
+        section_rows.append(row)
+        next_row = only_child[row]
+        while next_row >= 0 and not starts_section[next_row]:
+            section_rows.append(next_row)
+            next_row = only_child[next_row]
+        section_coord = swc_data[section_rows, 2:5]
+        # Traces converted from iv repeat the parent point as the first node of a child filament
+        if len(section_coord) > 1 and (section_coord[0] == section_coord[1]).all():
+            section_coord = section_coord[1:]
+        sections.append((node_types[row], section_coord))
+    return sections
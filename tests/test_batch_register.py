@@ -0,0 +1,36 @@
+import json
+import multiprocessing
+import os
+import time
+import pytest
+import batch_register
+
+JOB_SECONDS = 0.5
+
+
+def fake_registration_job(config):
+    # Stand-in for run_registration_job: the 'crash' specimen kills its worker process shortly after starting
+    if os.path.basename(config['home_directory']) == 'crash':
+        time.sleep(0.1)
+        os._exit(1)
+    time.sleep(JOB_SECONDS)
+    return {'home_directory': config['home_directory'], 'status': 'done', 'seconds': JOB_SECONDS}
+
+
+@pytest.mark.skipif(multiprocessing.get_start_method() != 'fork', reason='the workers must inherit the fake job')
+def test_crash_is_charged_to_its_job_only(tmp_path, monkeypatch):
+    monkeypatch.setattr(batch_register, 'run_registration_job', fake_registration_job)
+    names = ['a', 'b', 'crash', 'c', 'd', 'e', 'f', 'g']
+    for name in names:
+        os.makedirs(tmp_path / name)
+    start_time = time.perf_counter()
+    summary = batch_register.batch_register([str(tmp_path / '*')], {}, workers=4, retries=1,
+                                            report_path=str(tmp_path / 'report.json'))
+    seconds = time.perf_counter() - start_time
+    assert summary['n_done'] == len(names) - 1 and summary['n_failed'] == 1
+    with open(tmp_path / 'report.json') as f:
+        jobs = {os.path.basename(job['home_directory']): job for job in json.load(f)['jobs']}
+    assert jobs['crash']['attempts'] == 2
+    assert all(job['attempts'] == 1 for name, job in jobs.items() if name != 'crash')
+    # The other jobs keep running 4 at a time (one at a time they would take 7 * JOB_SECONDS)
+    assert seconds < 5 * JOB_SECONDS
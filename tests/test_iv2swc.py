@@ -0,0 +1,52 @@
+import json
+import os
+import numpy as np
+import pytest
+from benchmark import make_tree, write_iv
+from iv2swc import iv2dic, dic2swc
+from batch_iv2swc import batch_iv2swc
+
+# Two filaments, each starting where the other ends: p -> q and q -> p
+CYCLIC_FILAMENTS = [np.array([[0.0, 0.0, 0.0], [1.0, 0.0, 0.0], [2.0, 0.0, 0.0]]),
+                    np.array([[2.0, 0.0, 0.0], [1.0, 1.0, 0.0], [0.0, 0.0, 0.0]])]
+
+
+def read_iv(iv_file_path):
+    with open(iv_file_path, 'rb') as f:
+        return f.read()
+
+
+def test_tree_is_converted(tmp_path):
+    filaments = make_tree(depth=3, branching=2, n_points=5, extent=(100, 100, 100))
+    swc_txt = dic2swc(*iv2dic(read_iv(write_iv(str(tmp_path / 'tree.iv'), filaments))))
+    assert swc_txt.count('\n') == sum(len(filament) for filament in filaments)
+
+
+def test_cyclic_filaments_raise(tmp_path):
+    iv_file_path = write_iv(str(tmp_path / 'cycle.iv'), CYCLIC_FILAMENTS)
+    with pytest.raises(ValueError, match='cycle'):
+        dic2swc(*iv2dic(read_iv(iv_file_path)))
+
+
+def test_batch_reports_cyclic_file_as_failed(tmp_path):
+    write_iv(str(tmp_path / 'cycle.iv'), CYCLIC_FILAMENTS)
+    write_iv(str(tmp_path / 'tree.iv'), make_tree(depth=2, branching=2, n_points=5, extent=(100, 100, 100)))
+    summary = batch_iv2swc(str(tmp_path), workers=2)
+    assert summary['n_failed'] == 1 and summary['n_converted'] == 1
+    assert not os.path.exists(tmp_path / 'cycle.swc')
+
+
+@pytest.mark.parametrize('check', ['mtime', 'hash'])
+def test_failed_file_is_not_skipped_on_rerun(tmp_path, check):
+    # An older swc file next to an iv file whose conversion fails must not make the iv file look up to date
+    iv_file_path = write_iv(str(tmp_path / 'cycle.iv'), CYCLIC_FILAMENTS)
+    with open(tmp_path / 'cycle.swc', 'w') as f:
+        f.write('1 2 0 0 0 0.1 -1\n')
+    iv_mtime = os.path.getmtime(iv_file_path)
+    os.utime(tmp_path / 'cycle.swc', (iv_mtime - 60, iv_mtime - 60))
+    for _ in range(2):
+        summary = batch_iv2swc(str(tmp_path), workers=1, check=check)
+        assert summary['n_failed'] == 1 and summary['n_skipped'] == 0
+    with open(tmp_path / 'iv2swc_manifest.json') as f:
+        entry = json.load(f)['files'][0]
+    assert entry['iv_path'] == iv_file_path and 'sha256' not in entry
@@ -0,0 +1,82 @@
+import os
+import numpy as np
+import pytest
+from benchmark import make_volume, make_landmarks, make_tree, write_iv
+from coordinates import write_coord_csv
+from registration import register_specimen, get_config
+from utility import save_image
+
+SHAPE = (20, 80, 70)
+# Z, Y, X pixel size (um) of the raw image: binned by 2 (the default image_bin_factor) it is isotropic
+PIXEL_SIZE = np.array([1.0, 0.5, 0.5])
+ICS_HEADER = ('\nics_version\t1.0\nfilename\timg\nlayout\tparameters\t5\nlayout\torder\tbits\tx\ty\tz\tch\n'
+              'layout\tsizes\t16\t{x}\t{y}\t{z}\t{c}\nlayout\tcoordinates\tvideo\nlayout\tsignificant_bits\t16\n'
+              'representation\tformat\tinteger\nrepresentation\tsign\tunsigned\n'
+              'representation\tcompression\tuncompressed\nrepresentation\tbyte_order\t1\t2\n'
+              'parameter\tunits\tbits\tmicrometers\tmicrometers\tmicrometers\tundefined\n'
+              'parameter\tscale\t1.000000\t{px}\t{py}\t{pz}\t1.000000\nend\n')
+
+
+@pytest.fixture(scope='module')
+def specimen(tmp_path_factory):
+    # Specimen directory (tif, ics, landmarks and an iv trace) and target landmarks related to it by a non-rigid
+    # affine transformation plus jitter, so that the point and image matrices differ and the TPS warp is not trivial
+    root = tmp_path_factory.mktemp('registration')
+    home_directory = os.path.join(root, 'specimen')
+    os.makedirs(home_directory)
+    save_image(os.path.join(home_directory, 'img.tif'), make_volume(SHAPE), keep_dtype=True)
+    with open(os.path.join(home_directory, 'img.ics'), 'w') as f:
+        f.write(ICS_HEADER.format(x=SHAPE[2], y=SHAPE[1], z=SHAPE[0], c=2, px=PIXEL_SIZE[2], py=PIXEL_SIZE[1],
+                                  pz=PIXEL_SIZE[0]))
+    control_coord, target_coord = make_landmarks(SHAPE, jitter=1.0)
+    centre = np.asarray(SHAPE) / 2
+    target_coord = (target_coord - centre) @ np.diag([1.0, 1.1, 0.9]) + centre
+    write_coord_csv(os.path.join(home_directory, 'control.csv'), control_coord * PIXEL_SIZE)
+    target_coord_path = os.path.join(root, 'target.csv')
+    write_coord_csv(target_coord_path, target_coord * PIXEL_SIZE)
+    write_iv(os.path.join(home_directory, 'trace.iv'), make_tree(2, 2, 5, (30, 35, 15)))
+    return home_directory, target_coord_path
+
+
+def test_pyramid_tps_matches_fused_tps(specimen):
+    # The pyramid mode warps the binned level once with the composed linear and TPS pull-back; apart from the
+    # resampling differences near the edges it must give the fused (two pass) result
+    home_directory, target_coord_path = specimen
+    config = {'home_directory': home_directory, 'target_coord_path': target_coord_path, 'use_stage_cache': False,
+              'log_level': 'WARNING', 'evaluate_quality': False}
+    image_fused = np.asarray(register_specimen(dict(config, pyramid_levels=0))['image_TPS'], dtype=np.float64)
+    image_pyramid = np.asarray(register_specimen(dict(config, pyramid_levels=1))['image_TPS'], dtype=np.float64)
+    assert image_pyramid.shape == image_fused.shape
+    margin = 4
+    interior = (slice(margin, -margin),) * 3
+    image_fused, image_pyramid = image_fused[interior], image_pyramid[interior]
+    assert np.abs(image_pyramid - image_fused).mean() < 0.02 * np.abs(image_fused).mean()
+    assert np.corrcoef(image_pyramid.ravel(), image_fused.ravel())[0, 1] > 0.999
+
+
+@pytest.mark.parametrize('precision', ['float64', 'float32'])
+@pytest.mark.parametrize('do_tps', [False, True])
+def test_pyramid_output_dtype_follows_precision(specimen, precision, do_tps):
+    home_directory, target_coord_path = specimen
+    results = register_specimen({'home_directory': home_directory, 'target_coord_path': target_coord_path,
+                                 'use_stage_cache': False, 'log_level': 'WARNING', 'evaluate_quality': False,
+                                 'pyramid_levels': 1, 'precision': precision, 'do_tps': do_tps})
+    image = results['image_TPS'] if do_tps else results['image_LT']
+    assert image.dtype == np.dtype(precision)
+    assert all(level.dtype == np.dtype(precision) for level in results['pyramid'][1:])
+
+
+@pytest.mark.parametrize('preview_level', [-1, 3])
+def test_preview_level_outside_of_the_pyramid_is_rejected(preview_level):
+    with pytest.raises(ValueError, match='preview_level'):
+        get_config({'home_directory': 'specimen', 'target_coord_path': 'target.csv', 'pyramid_levels': 2,
+                    'preview_level': preview_level})
+
+
+def test_preview_level_beyond_the_binned_levels_is_rejected(specimen):
+    # Binning the 20 z-planes stops after 5 levels, whatever pyramid_levels asks for
+    home_directory, target_coord_path = specimen
+    with pytest.raises(ValueError, match='preview_level'):
+        register_specimen({'home_directory': home_directory, 'target_coord_path': target_coord_path,
+                           'use_stage_cache': False, 'log_level': 'WARNING', 'evaluate_quality': False,
+                           'pyramid_levels': 8, 'preview_level': 7})
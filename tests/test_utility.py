@@ -0,0 +1,31 @@
+import numpy as np
+import pytest
+import scipy.ndimage as ndi
+from benchmark import make_volume
+from utility import scale_image, get_scaled_shape, linear_transform_image
+
+
+@pytest.mark.parametrize('workers', [1, 2, 3, 7])
+@pytest.mark.parametrize('z_size', [19, 20, 23])
+def test_scale_image_matches_untiled_call(workers, z_size):
+    # The last output plane samples the last input plane exactly; tiles must not round it out of the volume
+    image = make_volume((z_size, 48, 40), n_channels=1)
+    pixel_size = [2.3, 1.1, 1.0]
+    output_shape, step = get_scaled_shape(image.shape, pixel_size)
+    expected = ndi.affine_transform(image[..., 0], step, output_shape=output_shape, order=3, mode='constant')
+    image_scaled, _ = scale_image(image, pixel_size, workers=workers)
+    np.testing.assert_array_equal(image_scaled[..., 0], expected)
+
+
+@pytest.mark.parametrize('workers', [1, 2, 3, 7])
+def test_linear_transform_matches_untiled_call(workers):
+    image = make_volume((21, 32, 30), n_channels=2)
+    rng = np.random.default_rng(1)
+    transform_matrix = np.eye(4)
+    transform_matrix[:3, :3] += rng.normal(0, 0.1, (3, 3))
+    transform_matrix[:3, 3] = rng.normal(0, 2, 3)
+    image_transformed = linear_transform_image(image, transform_matrix, workers=workers)
+    for channel in range(image.shape[3]):
+        expected = ndi.affine_transform(image[..., channel], transform_matrix[:3, :3], offset=transform_matrix[:3, 3],
+                                        order=3, mode='constant')
+        np.testing.assert_array_equal(image_transformed[..., channel], expected)
@@ -0,0 +1,175 @@
+import json
+import os
+import numpy as np
+from point_transform import POINT_BLOCK_SIZE, evaluate_tps, evaluate_affine, _map_blocks
+from coordinates import transform_swc
+
+# Regularization of the thin plate splines fitted by the pipeline
+TPS_ALPHA = 0.5
+TRANSFORM_FILE_VERSION = 1
+
+
+class AffineTransform:
+    # Linear transformation of (N, 3) ZYX pixel coordinates: transformed = matrix @ [coord, 1]
+    # Exactly invertible; fitted with the same least squares solution as get_transform_matrix
+
+    def __init__(self, matrix):
+        self.matrix = np.asarray(matrix, dtype=np.float64)
+        self.control_points = np.empty((0, 3))
+
+    @classmethod
+    def fit(cls, source_coord, target_coord, transform_type='affine'):
+        # Transformation mapping source_coord onto target_coord; transform_type: 'affine' or 'rigid'
+        if transform_type not in ('affine', 'rigid'):
+            raise ValueError('Unknown transform_type ' + str(transform_type) + ' (must be affine or rigid)')
+        from transforms3d._gohlketransforms import affine_matrix_from_points
+        rigid = transform_type == 'rigid'
+        return cls(affine_matrix_from_points(np.asarray(source_coord).T, np.asarray(target_coord).T,
+                                             shear=not rigid, scale=not rigid))
+
+    def apply(self, coord, block_size=POINT_BLOCK_SIZE, dtype=np.float64, workers=1):
+        return evaluate_affine(coord, self.matrix, block_size, dtype, workers)
+
+    def inverse(self):
+        return AffineTransform(np.linalg.inv(self.matrix))
+
+    def to_dict(self):
+        return {'type': 'affine', 'matrix': self.matrix.tolist()}
+
+    # Same interface as ThinPlateSpline, so that transforms can be given to tps_transform_image
+    transform = apply
+
+
+class TpsTransform:
+    # Thin plate spline mapping the source landmarks onto the target landmarks (ZYX pixel coordinates)
+    # The spline is stored by its fitted parameters, so loading it from disk needs no refitting. The inverse is
+    # approximated by the spline fitted the other way round (target onto source), as done by the pipeline.
+
+    def __init__(self, source_coord, target_coord, parameters, alpha=TPS_ALPHA, inverse_parameters=None):
+        self.source_coord = np.asarray(source_coord, dtype=np.float64)
+        self.target_coord = np.asarray(target_coord, dtype=np.float64)
+        self.parameters = np.asarray(parameters, dtype=np.float64)
+        self.alpha = alpha
+        self.inverse_parameters = None if inverse_parameters is None else np.asarray(inverse_parameters,
+                                                                                     dtype=np.float64)
+        self.control_points = self.source_coord
+
+    @classmethod
+    def fit(cls, source_coord, target_coord, alpha=TPS_ALPHA):
+        from tps import ThinPlateSpline
+        tps_fun = ThinPlateSpline(alpha)
+        tps_fun.fit(np.asarray(source_coord, dtype=np.float64), np.asarray(target_coord, dtype=np.float64))
+        return cls(source_coord, target_coord, tps_fun.parameters, alpha)
+
+    def apply(self, coord, block_size=POINT_BLOCK_SIZE, dtype=np.float64, workers=1):
+        return evaluate_tps(coord, self.source_coord, self.parameters, block_size, dtype, workers)
+
+    def inverse(self):
+        if self.inverse_parameters is None:
+            self.inverse_parameters = TpsTransform.fit(self.target_coord, self.source_coord, self.alpha).parameters
+        return TpsTransform(self.target_coord, self.source_coord, self.inverse_parameters, self.alpha,
+                            self.parameters)
+
+    def to_dict(self):
+        transform_dict = {'type': 'tps', 'alpha': self.alpha, 'source_coord': self.source_coord.tolist(),
+                          'target_coord': self.target_coord.tolist(), 'parameters': self.parameters.tolist()}
+        if self.inverse_parameters is not None:
+            transform_dict['inverse_parameters'] = self.inverse_parameters.tolist()
+        return transform_dict
+
+    transform = apply
+
+
+class CompositeTransform:
+    # Transformations applied one after the other (the first of the list first)
+
+    def __init__(self, transforms):
+        self.transforms = list(transforms)
+        # Landmarks of the splines (used to check grid approximations of the composed transformation)
+        self.control_points = np.concatenate([np.empty((0, 3))] + [transform.control_points
+                                                                   for transform in self.transforms])
+
+    def apply(self, coord, block_size=POINT_BLOCK_SIZE, dtype=np.float64, workers=1):
+        # Each block of points goes through the whole chain, so memory use stays fixed
+        coord = np.asarray(coord)
+        output = np.empty((len(coord), 3), dtype=dtype)
+
+        def apply_block(start, stop):
+            block = coord[start:stop]
+            for transform in self.transforms:
+                block = transform.apply(block, block_size, dtype)
+            output[start:stop] = block
+
+        _map_blocks(apply_block, len(coord), block_size, workers)
+        return output
+
+    def inverse(self):
+        return CompositeTransform([transform.inverse() for transform in reversed(self.transforms)])
+
+    def to_dict(self):
+        return {'type': 'composite', 'transforms': [transform.to_dict() for transform in self.transforms]}
+
+    transform = apply
+
+
+def transform_from_dict(transform_dict):
+    if transform_dict['type'] == 'affine':
+        return AffineTransform(transform_dict['matrix'])
+    if transform_dict['type'] == 'tps':
+        return TpsTransform(transform_dict['source_coord'], transform_dict['target_coord'],
+                            transform_dict['parameters'], transform_dict['alpha'],
+                            transform_dict.get('inverse_parameters'))
+    if transform_dict['type'] == 'composite':
+        return CompositeTransform([transform_from_dict(item) for item in transform_dict['transforms']])
+    raise ValueError('Unknown transform type ' + str(transform_dict['type']))
+
+
+def save_transform(transform_path, transform, **metadata):
+    # Save a transformation as json, with metadata such as the pixel_size its pixel coordinates refer to
+    with open(transform_path, 'w') as f:
+        json.dump({'version': TRANSFORM_FILE_VERSION, 'metadata': metadata, 'transform': transform.to_dict()}, f)
+    return transform_path
+
+
+def load_transform(transform_path):
+    # Transformation and metadata saved by save_transform
+    with open(transform_path, 'r') as f:
+        saved = json.load(f)
+    return transform_from_dict(saved['transform']), saved['metadata']
+
+
+def _transform_swc_task(task):
+    transform, swc_file_path, pixel_size, transformed_swc_path = task
+    return transform_swc(swc_file_path, transform.apply, pixel_size, transformed_swc_path)
+
+
+def transform_swc_files(transform, swc_file_paths, pixel_size, output_directory, suffix='_transformed', workers=1):
+    # Apply a (fitted or loaded) transformation to many swc files, written to output_directory as <name><suffix>.swc
+    # pixel_size: pixel size of the pixel coordinates the transformation works in
+    tasks = [(transform, swc_file_path, pixel_size,
+              os.path.join(output_directory, os.path.basename(swc_file_path)[:-4] + suffix + '.swc'))
+             for swc_file_path in swc_file_paths]
+    if workers == 1:
+        return [_transform_swc_task(task) for task in tasks]
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(_transform_swc_task, tasks, chunksize=max(1, len(tasks) // (4 * (workers or 1)))))
+
+
+def warp_image(image, transform, output_shape=None, grid_spacing=None, workers=1, scratch_directory=None):
+    # Resample a ZYXC image into the space of the transformation: output voxel o takes the value of the image at
+    # transform.inverse().apply(o) (pixel coordinates of the image). Affine transformations use the tiled affine
+    # resampler; anything containing a spline is warped chunk by chunk by tps_transform_image
+    # The volume processing (scipy, tifffile) is only imported here, so that point transforms start quickly
+    from utility import tps_transform_image, linear_transform_image, _affine_resample
+    pull_back = transform.inverse()
+    if isinstance(pull_back, AffineTransform):
+        if output_shape is None:
+            return linear_transform_image(image, pull_back.matrix, workers=workers,
+                                          scratch_directory=scratch_directory)
+        return _affine_resample(image, pull_back.matrix[:3, :3], pull_back.matrix[:3, 3], output_shape, image.dtype,
+                                workers, scratch_directory)
+    image_warped, _ = tps_transform_image(image, None, None, grid_spacing=grid_spacing, workers=workers,
+                                          scratch_directory=scratch_directory, output_shape=output_shape,
+                                          tps_fun=pull_back)
+    return image_warped
@@ -1,249 +1,489 @@
-import csv
 import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-import neurom as nm
-from scipy.ndimage import zoom
-from transforms3d._gohlketransforms import affine_matrix_from_points
 from scipy import ndimage as ndi
 from skimage.measure import block_reduce
 from tps import ThinPlateSpline
 from scipy.ndimage import map_coordinates
+import tifffile
 from tifffile import imwrite
-
-
-def make_directory(new_directory_path):
-    is_exists = os.path.exists(new_directory_path)
-    if not is_exists:
-        os.mkdir(new_directory_path)
-        print(new_directory_path, " is created")
+from instrumentation import instrumented, logger
+from point_transform import POINT_BLOCK_SIZE
+# Coordinate and swc operations live in the light coordinates module; they are re-exported here for existing callers
+from coordinates import make_directory, find_files, get_pixel_size, um_to_pixel, pixel_to_um, \
+    get_axon_dendrite_for_napari, read_coord_csv, write_coord_csv, get_transform_matrix, linear_transform_coord, \
+    transform_swc, linear_transform_swc, tps_transform_swc, _evaluate_spline
+
+
+def allocate_array(shape, dtype, scratch_directory=None):
+    # Zero-initialised array in memory, or - for out-of-core processing - memory-mapped onto an anonymous temporary
+    # file in scratch_directory, which is removed automatically once the array is released
+    if scratch_directory is None:
+        return np.zeros(shape, dtype=dtype)
+    return np.memmap(tempfile.TemporaryFile(dir=scratch_directory), dtype=dtype, mode='w+', shape=tuple(shape))
+
+
+@instrumented
+def read_tif(tif_path, use_memmap=False):
+    # Read an ImageJ tif (ZCYX) as a ZYXC image
+    # use_memmap: leave the pixel data on disk (memory-mapped, read only); only possible for uncompressed tif files
+    image = None
+    if use_memmap:
+        try:
+            image = tifffile.memmap(tif_path, mode='r')
+        except ValueError:
+            logger.warning('%s cannot be memory-mapped (compressed or tiled), reading it into memory', tif_path)
+    if image is None:
+        image = tifffile.imread(tif_path)
+    # Image J saves image in the format ZCYX however in scikit image processed as ZYXC
+    return np.transpose(image, (0, 2, 3, 1))
+
+
+def _resolve_workers(workers):
+    # workers=None uses every available core
+    if workers is None:
+        workers = os.cpu_count() or 1
+    return max(1, int(workers))
+
+
+def _parallel_map(function, tasks, workers):
+    # Run function over tasks on a thread pool; scipy.ndimage and the numpy kernels release the GIL
+    workers = _resolve_workers(workers)
+    if workers == 1:
+        return [function(task) for task in tasks]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(function, tasks))
+
+
+def _z_slabs(z_size, workers):
+    # Split the z axis into slabs (a few per worker for load balancing)
+    n_slabs = 1 if _resolve_workers(workers) == 1 else min(z_size, 4 * _resolve_workers(workers))
+    bounds = np.linspace(0, z_size, n_slabs + 1).astype(int)
+    return [(z_start, z_stop) for z_start, z_stop in zip(bounds[:-1], bounds[1:]) if z_stop > z_start]
+
+
+def get_compute_dtype(dtype):
+    # Floating point type in which a stage producing dtype interpolates (spline coefficients and coordinates):
+    # float32 results (precision 'float32') are computed in float32, anything else in float64
+    return np.dtype(np.float32) if np.dtype(dtype) == np.float32 else np.dtype(np.float64)
+
+
+def _spline_prefilter(image, workers, scratch_directory=None, dtype=np.float64):
+    # Cubic spline prefilter of every channel (the same filter ndimage applies on each interpolation call), computed
+    # once so that interpolation can run tile by tile with prefilter=False
+    def prefilter_channel(channel):
+        filtered = allocate_array(image.shape[0:3], dtype, scratch_directory)
+        ndi.spline_filter(image[..., channel], order=3, output=filtered, mode='constant')
+        return filtered
+
+    return _parallel_map(prefilter_channel, range(image.shape[3]), workers)
+
+
+def _plane_coordinates(matrix, offset, z, plane_shape):
+    # Input indices of the output plane z, with the floating point operations of ndimage.affine_transform, so that
+    # samples on the edge of the input fall inside or outside of it exactly as in a single untiled call
+    # (matrix: (3,) zoom as in zoom_shift, or (3, 3) applied as ((offset + m_z * z) + m_y * y) + m_x * x)
+    y = np.arange(plane_shape[0], dtype=np.float64)
+    x = np.arange(plane_shape[1], dtype=np.float64)
+    coordinates = np.empty((3,) + tuple(plane_shape))
+    if matrix.ndim == 1:
+        shift = offset / matrix
+        coordinates[0] = (z + shift[0]) * matrix[0]
+        coordinates[1] = ((y + shift[1]) * matrix[1])[:, np.newaxis]
+        coordinates[2] = ((x + shift[2]) * matrix[2])[np.newaxis, :]
     else:
-        print(new_directory_path, " already exists")
-
-
-def find_files(home_directory, file_extension):
-    file_found = 0
-    for file in os.listdir(home_directory):
-        if file.endswith(file_extension):
-            file_found = file_found + 1
-            file_name = file
-            print(file_extension, " file found: ", file_name)
-            file_path = os.path.join(home_directory, file_name)
-    if file_found == 0:
-        print("WARNING: ", file_extension, " file not found in ", home_directory)
-        file_path = None
-    return file_path
-
-
-def get_pixel_size(ics_path):
-    with open(ics_path, "r", encoding="utf-8") as f:
-        reader = csv.reader(f, delimiter="\t")
-        ics = list(reader)
-    pixel_size_x = float(ics[13][3])
-    pixel_size_y = float(ics[13][4])
-    pixel_size_z = float(ics[13][5])
-    pixel_size = [pixel_size_z, pixel_size_y, pixel_size_x]
-    return np.array(pixel_size)
-
-
-def scale_image(image, pixel_size):
-    # Scale the original image such that all axis have the save pixel size (pixel_size_x)
-    print('Scaling images so that pixel sizes of all dimension = ', pixel_size[2], 'um (equivalent to x pixel size)')
+        for axis in range(3):
+            coordinates[axis] = ((offset[axis] + matrix[axis, 0] * z) + matrix[axis, 1] * y)[:, np.newaxis] + \
+                                (matrix[axis, 2] * x)[np.newaxis, :]
+    return coordinates
+
+
+def _affine_resample(image, matrix, offset, output_shape, output_dtype, workers, scratch_directory=None):
+    # Resample every channel of a ZYXC image with input_index = matrix @ output_index + offset, tile by tile
+    n_channels = image.shape[3]
+    matrix = np.asarray(matrix, dtype=np.float64)
+    offset = np.asarray(offset, dtype=np.float64)
+    output = allocate_array(tuple(output_shape) + (n_channels,), output_dtype, scratch_directory)
+    filtered_channels = _spline_prefilter(image, workers, scratch_directory, get_compute_dtype(output_dtype))
+
+    def resample_tile(task):
+        # Plane by plane over a z-slab of the output; the coordinates are those of the untiled call (shifting the
+        # offset per slab instead rounds differently, and samples on the last input plane then fall outside of it)
+        channel, z_start, z_stop = task
+        for z in range(z_start, z_stop):
+            output[z, :, :, channel] = ndi.map_coordinates(
+                filtered_channels[channel], _plane_coordinates(matrix, offset, z, output_shape[1:3]),
+                output=output_dtype, prefilter=False)
+
+    _parallel_map(resample_tile, [(channel, z_start, z_stop) for channel in range(n_channels)
+                                  for z_start, z_stop in _z_slabs(output_shape[0], workers)], workers)
+    return output
+
+
+def get_scaled_shape(image_shape, pixel_size):
+    # Shape of the isotropically scaled image and the input index step per output index along each axis, exactly as
+    # computed by scipy.ndimage.zoom
     zoom_z = pixel_size[0] / pixel_size[2]
     zoom_y = pixel_size[1] / pixel_size[2]
     zoom_x = pixel_size[2] / pixel_size[2]
-    print("\tScaling for ch0...", end="", flush=True)
-    image_scaled_ch0 = zoom(image[:, :, :, 0], (zoom_z, zoom_y, zoom_x))
-    print("[DONE]")
-    print("\tScaling for ch1...", end="", flush=True)
-    image_scaled_ch1 = zoom(image[:, :, :, 1], (zoom_z, zoom_y, zoom_x))
-    print("[DONE]")
-    image_scaled = np.stack((image_scaled_ch0, image_scaled_ch1), axis=3)
+    input_shape = np.array(image_shape[0:3])
+    output_shape = np.array([round(size * factor) for size, factor in zip(input_shape, (zoom_z, zoom_y, zoom_x))])
+    step = np.divide(input_shape - 1, output_shape - 1, out=np.ones(3), where=output_shape > 1)
+    return tuple(output_shape), step
+
+
+@instrumented
+def scale_image(image, pixel_size, workers=1, scratch_directory=None):
+    # Scale the original image such that all axis have the save pixel size (pixel_size_x)
+    logger.info('Scaling images so that pixel sizes of all dimension = %s um (equivalent to x pixel size)',
+                pixel_size[2])
+    output_shape, step = get_scaled_shape(image.shape, pixel_size)
+    logger.info('\tScaling %s channels...', image.shape[3])
+    image_scaled = _affine_resample(image, step, np.zeros(3), output_shape, image.dtype, workers, scratch_directory)
     # Get new pixel size
     pixel_size = [pixel_size[2], pixel_size[2], pixel_size[2]]
     return image_scaled, pixel_size
 
 
-def um_to_pixel(um_data, pixel_size):
-    pixel_data = np.zeros_like(um_data)
-    pixel_data[:, 0] = um_data[:, 0] / pixel_size[0]
-    pixel_data[:, 1] = um_data[:, 1] / pixel_size[1]
-    pixel_data[:, 2] = um_data[:, 2] / pixel_size[2]
-    return pixel_data
-
-
-def pixel_to_um(pixel_data, pixel_size):
-    um_data = np.zeros_like(pixel_data)
-    um_data[:, 0] = pixel_data[:, 0] * pixel_size[0]
-    um_data[:, 1] = pixel_data[:, 1] * pixel_size[1]
-    um_data[:, 2] = pixel_data[:, 2] * pixel_size[2]
-    return um_data
-
-
-def get_axon_dendrite_for_napari(swc_path, pixel_size):
-    m = nm.load_morphology(swc_path)
-    axon = []
-    dendrite = []
-    for n in m.neurites:
-        for section in n.iter_sections():
-            coord = section.points[:, :3]
-            coord = um_to_pixel(coord, pixel_size)
-            coord = np.flip(coord, axis=1)
-            if section.type == 2:
-                axon.append(coord)
-            elif section.type == 3:
-                dendrite.append(coord)
-    return axon, dendrite
-
-
-def read_coord_csv(csv_path):
-    with open(csv_path, "r", encoding="utf-8-sig") as f:
-        reader = csv.reader(f, delimiter=",")
-        csv_data = list(reader)
-    # Get rid of the last column data
-    csv_data = np.array(csv_data)
-    csv_data = csv_data[:, 0:3]
-    csv_data = np.array(csv_data, dtype=float)
-    # Re-order the axis to zyx
-    csv_data = np.flip(csv_data, axis=1)
-    return csv_data
-
-
-def write_coord_csv(csv_path, csv_data):
-    csv_data = np.flip(csv_data, axis=1)
-    with open(csv_path, 'w', newline='') as f:
-        writer = csv.writer(f, delimiter=",")
-        writer.writerows(csv_data)
-
-
-def get_transform_matrix(control_coord, target_coord, transform_type):
-    print("Calculating the transformation matrix... ", end="", flush=True)
-    if transform_type == "affine":
-        transform_matrix = affine_matrix_from_points(target_coord.T, control_coord.T)
-    elif transform_type == "rigid":
-        transform_matrix = affine_matrix_from_points(target_coord.T, control_coord.T, shear=False, scale=False)
-    else:
-        print("Unknown transform_type (must be affine or rigid)")
-    print("[DONE]")
-    return transform_matrix
-
-
-def linear_transform_image(image, transform_matrix):
-    print("Performing linear transformation of a given image based on the transformation matrix: ")
-    image_after_transform = np.zeros_like(image)
-    print("\tLinearly transforming ch0... ", end="", flush=True)
-    image_after_transform[:, :, :, 0] = ndi.affine_transform(image[:, :, :, 0], transform_matrix)
-    print("[DONE]")
-    print("\tLinearly transforming ch1... ", end="", flush=True)
-    image_after_transform[:, :, :, 1] = ndi.affine_transform(image[:, :, :, 1], transform_matrix)
-    print("[DONE]")
+@instrumented
+def linear_transform_image(image, transform_matrix, workers=1, scratch_directory=None):
+    logger.info('Performing linear transformation of a given image based on the transformation matrix')
+    # Homogeneous (4, 4) matrix mapping output indices to input indices
+    transform_matrix = np.asarray(transform_matrix, dtype=np.float64)
+    logger.info('\tLinearly transforming %s channels...', image.shape[3])
+    image_after_transform = _affine_resample(image, transform_matrix[:3, :3], transform_matrix[:3, 3],
+                                             image.shape[0:3], image.dtype, workers, scratch_directory)
     return image_after_transform
 
 
-def linear_transform_coord(coord, transform_matrix):
-    print("Performing linear transformation of the given coordinates based on the transformation matrix... ", end="",
-          flush=True)
-    coord_for_transformation = np.copy(coord.T)
-    coord_for_transformation = np.append(coord_for_transformation, np.ones((1, coord_for_transformation.shape[1])),
-                                         axis=0)
-    transformed_coord_transposed = np.matmul(transform_matrix, coord_for_transformation)
-    print("[DONE]")
-    return transformed_coord_transposed[:3].T
-
-
-def linear_transform_swc(swc_file_path, transform_matrix, pixel_size, transformed_swc_path):
-    print("Performing linear transformation of the given neurite data based on the transformation matrix... ", end="",
-          flush=True)
-    # Read the neurite coordinates
-    swc_data = np.loadtxt(swc_file_path, delimiter=' ')
-    # extract only the coordinates part
-    swc_coord = swc_data[:, 2:5]
-    # Convert to ZYX format for processing
-    swc_coord = np.flip(swc_coord, axis=1)
-    # Convert to pixel unit
-    swc_coord = um_to_pixel(swc_coord, pixel_size)
-    # Perform affine transform
-    swc_coord_transformed = linear_transform_coord(swc_coord, transform_matrix)
-    # Convert it back to um unit
-    swc_coord_transformed = pixel_to_um(swc_coord_transformed, pixel_size)
-    # Convert it back to XYZ format for saving
-    swc_coord_transformed = np.flip(swc_coord_transformed, axis=1)
-    # Put it back to the swc_data
-    swc_data[:, 2:5] = swc_coord_transformed
-    # Save the result as a swc file
-    fmt = '%d', '%d', '%1.6f', '%1.6f', '%1.6f', '%1.1f', '%d'
-    print('Writing ', transformed_swc_path)
-    np.savetxt(transformed_swc_path, swc_data, fmt=fmt, delimiter=' ')
-    print("[DONE]")
-    return transformed_swc_path
-
-
-def downsample(image, bin_factor):
+def get_composed_matrix(image_shape, pixel_size, transform_matrix, bin_factor=1):
+    # Output shape, and matrix and offset mapping the output indices of the composed downsample, scaling and linear
+    # transformation onto the indices of the binned image (binned index = matrix @ output index + offset)
+    binned_shape = tuple(int(np.ceil(size / bin_factor)) for size in image_shape[0:3])
+    output_shape, step = get_scaled_shape(binned_shape, np.asarray(pixel_size) * bin_factor)
+    # scaled index p = M @ o + t; binned index q = step * p
+    transform_matrix = np.asarray(transform_matrix, dtype=np.float64)
+    return output_shape, step[:, None] * transform_matrix[:3, :3], step * transform_matrix[:3, 3]
+
+
+@instrumented
+def composed_transform_image(image, pixel_size, transform_matrix, bin_factor=1, bin_prefilter=True, workers=1,
+                             scratch_directory=None, dtype=np.float64):
+    # Downsample, isotropic scaling and linear transformation of the raw image in a single resampling pass
+    # Equivalent (within interpolation tolerance) to:
+    #   image_scaled, _ = scale_image(downsample(image, bin_factor), pixel_size * bin_factor)
+    #   linear_transform_image(image_scaled, transform_matrix)
+    # pixel_size: pixel size of the raw (not binned) image
+    # bin_prefilter: block-average the raw image before resampling (as downsample does, avoids aliasing); otherwise
+    #   the raw image is sampled directly at the centres of the bins
+    # dtype: dtype of the result (np.float32 halves the memory of the result and of the spline coefficients)
+    logger.info('Performing composed downsample, scaling and linear transformation of a given image')
+    output_shape, matrix, offset = get_composed_matrix(image.shape, pixel_size, transform_matrix, bin_factor)
+    if bin_factor > 1 and bin_prefilter:
+        image = downsample(image, bin_factor, scratch_directory=scratch_directory, dtype=dtype)
+    elif bin_factor > 1:
+        # raw index = bin_factor * q + centre of the bin
+        matrix = bin_factor * matrix
+        offset = bin_factor * offset + (bin_factor - 1) / 2
+    logger.info('\tResampling %s channels...', image.shape[3])
+    image_after_transform = _affine_resample(image, matrix, offset, output_shape, dtype, workers, scratch_directory)
+    pixel_size = [pixel_size[2] * bin_factor, pixel_size[2] * bin_factor, pixel_size[2] * bin_factor]
+    return image_after_transform, pixel_size
+
+
+@instrumented
+def downsample(image, bin_factor, block_planes=64, scratch_directory=None, output=None, dtype=np.float64):
     # Downsample image with dimensions ZYXC
-    print('Downsampling the image...', end="", flush=True)
-    image = block_reduce(image, block_size=(bin_factor, bin_factor, bin_factor, 1), func=np.mean)
-    print('[DONE]')
-    return image
-
-
-def tps_transform_image(image, control_coord, target_coord):
-    # Create the 3d meshgrid of indices of output image; Shape: (Z, Y, X, 3)
-    z_size, y_size, x_size = image.shape[0:3]
-    output_indices = np.indices((z_size, y_size, x_size), dtype=np.float64).transpose(1, 2, 3, 0)
-    # Transform it into the input indices
-    tps_fun = ThinPlateSpline(0.5)
-    tps_fun.fit(target_coord, control_coord)
-    input_indices = tps_fun.transform(output_indices.reshape(-1, 3)).reshape(z_size, y_size, x_size, 3)
-    # Interpolate the resulting image
-    img_transformed = np.concatenate(
-        [
-            map_coordinates(np.array(image)[..., channel], input_indices.transpose(3, 0, 1, 2))[..., None]
-            for channel in (0, 1)
-        ],
-        axis=-1,
-    )
-    return img_transformed, tps_fun
-
-
-def tps_transform_swc(swc_file_path, control_coord, target_coord, pixel_size, transformed_swc_path):
-    # NB: pre-process and post-process procedure basically the same as affine_transform_swc - consider combine the
-    # two later
-    print("Performing TPS transformation of the given neurite data based on the tps object... ", end=""
-          , flush=True)
-    # Read the neurite coordinates
-    swc_data = np.loadtxt(swc_file_path, delimiter=' ')
-    # extract only the coordinates part
-    swc_coord = swc_data[:, 2:5]
-    # Convert to ZYX format for processing
-    swc_coord = np.flip(swc_coord, axis=1)
-    # Convert to pixel unit
-    swc_coord = um_to_pixel(swc_coord, pixel_size)
-    # Perform transformation
-    tps_fun = ThinPlateSpline(0.5)
-    tps_fun.fit(control_coord, target_coord)
-    swc_coord_transformed = tps_fun.transform(swc_coord)
-    # Convert it back to um unit
-    swc_coord_transformed = pixel_to_um(swc_coord_transformed, pixel_size)
-    # Convert it back to XYZ format for saving
-    swc_coord_transformed = np.flip(swc_coord_transformed, axis=1)
-    # Put it back to the swc_data
-    swc_data[:, 2:5] = swc_coord_transformed
-    # Save the result as a swc file
-    fmt = '%d', '%d', '%1.6f', '%1.6f', '%1.6f', '%1.1f', '%d'
-    print('Writing ', transformed_swc_path)
-    np.savetxt(transformed_swc_path, swc_data, fmt=fmt, delimiter=' ')
-    print("[DONE]")
-    return transformed_swc_path
-
-
-def save_image(image_path, image):
-    # Convert image to UINT16 format
-    data_min = np.min(image)
-    data_max = np.max(image)
-    data_range = data_max - data_min
-    data_scale = 65535.0 / data_range
-    image_scaled = (image - data_min) * data_scale
-    image_scaled_uint8 = image_scaled.astype('uint16')
-    # Convert image to ZCYX format (ImageJ)
-    image_scaled_uint8_zcyx = image_scaled_uint8.transpose(0, 3, 1, 2)
-    # Write image
-    imwrite(image_path, image_scaled_uint8_zcyx, imagej=True, metadata={'axes': 'ZCYX'})
+    # The image is binned in slabs of block_planes output planes, so only one slab of the input is in memory at a time
+    # output: optional preallocated array (e.g. a memory-mapped .npy file) to write the binned image into
+    # dtype: dtype of the binned image (default: the dtype of output); the bin means are accumulated in this dtype
+    logger.info('Downsampling the image...')
+    output_shape = tuple(int(np.ceil(size / bin_factor)) for size in image.shape[0:3]) + (image.shape[3],)
+    image_binned = allocate_array(output_shape, dtype, scratch_directory) if output is None else output
+    mean_dtype = get_compute_dtype(image_binned.dtype)
+    for z_start in range(0, output_shape[0], block_planes):
+        z_stop = min(z_start + block_planes, output_shape[0])
+        image_binned[z_start:z_stop] = block_reduce(np.asarray(image[z_start * bin_factor:z_stop * bin_factor]),
+                                                    block_size=(bin_factor, bin_factor, bin_factor, 1), func=np.mean,
+                                                    func_kwargs={'dtype': mean_dtype})
+    return image_binned
+
+
+def _tps_chunk_voxels(n_control, row_size, n_channels, max_memory_mb):
+    # Number of output voxels that can be warped at once within the memory budget.
+    # Per voxel: output/input indices (3 float64 each, plus transposed copies) and one interpolated value per channel.
+    # The radial kernel against the control points only exists for one block of points at a time (evaluate_tps).
+    kernel_bytes = 2 * 8 * POINT_BLOCK_SIZE * (n_control + 4) if n_control else 0
+    bytes_per_voxel = 8 * (4 * 3 + n_channels)
+    chunk_voxels = max(0, int(max_memory_mb * 1024 ** 2) - kernel_bytes) // bytes_per_voxel
+    # Keep chunks aligned to whole image rows so they form z-slabs (or partial slabs of complete rows)
+    return max(row_size, chunk_voxels // row_size * row_size)
+
+
+def _tps_displacement_grid(tps_fun, shape, grid_spacing):
+    # Evaluate the TPS displacement (input index - output index) on a coarse lattice with nodes every grid_spacing
+    # voxels; the lattice covers the whole volume so that every output voxel lies inside a lattice cell
+    # Shape: (3, Gz, Gy, Gx)
+    grid_shape = tuple(int(np.ceil((size - 1) / grid_spacing)) + 1 for size in shape)
+    grid_indices = np.indices(grid_shape, dtype=np.float64).reshape(3, -1).T
+    grid_points = grid_indices * grid_spacing
+    displacement = tps_fun.transform(grid_points) - grid_points
+    return displacement.T.reshape((3,) + grid_shape)
+
+
+def _interpolate_displacement_grid(displacement_grid, output_indices, grid_spacing, grid_order):
+    # Upsample the coarse displacement field at the given output indices; Shape of output_indices: (3, N)
+    grid_coords = output_indices / grid_spacing
+    return np.stack([map_coordinates(component, grid_coords, order=grid_order, mode='mirror', prefilter=False)
+                     for component in displacement_grid])
+
+
+def tps_grid_max_error(tps_fun, displacement_grid, grid_spacing, grid_order):
+    # Maximum error (in voxels) of the upsampled displacement field against the exact spline
+    # Evaluated at the centres of the lattice cells, where the interpolation error of a smooth field is largest, and
+    # at the landmarks themselves, where the radial kernel has its kink
+    grid_shape = displacement_grid.shape[1:]
+    centres = (np.indices(tuple(size - 1 for size in grid_shape), dtype=np.float64).reshape(3, -1) + 0.5) \
+        * grid_spacing
+    grid_extent = (np.array(grid_shape) - 1) * grid_spacing
+    landmarks = tps_fun.control_points[((tps_fun.control_points >= 0) & (tps_fun.control_points <= grid_extent))
+                                       .all(axis=1)]
+    centres = np.concatenate([centres, landmarks.T], axis=1)
+    exact = tps_fun.transform(centres.T).T - centres
+    approx = _interpolate_displacement_grid(displacement_grid, centres, grid_spacing, grid_order)
+    return np.max(np.linalg.norm(exact - approx, axis=0))
+
+
+@instrumented
+def tps_transform_image(image, control_coord, target_coord, max_memory_mb=1024, output=None, grid_spacing=None,
+                        grid_order=1, workers=1, scratch_directory=None, output_shape=None, output_scale=1,
+                        input_matrix=None, input_offset=None, tps_fun=None):
+    # Warp the output volume chunk by chunk so that the full coordinate grid is never materialized
+    # output: optional preallocated array (e.g. np.memmap) with the output shape to write the result into
+    # grid_spacing: if given, evaluate the spline only every grid_spacing voxels and upsample the displacement field
+    #   with grid_order interpolation (1: trilinear, 3: cubic) - an approximate but much faster mode
+    # workers: number of threads warping chunks concurrently (max_memory_mb is shared between them)
+    # scratch_directory: keep the prefiltered channels and the output on disk (memory-mapped) instead of in memory
+    # output_shape, output_scale: warp onto a grid of output_shape (default: image shape) whose voxel o lies at
+    #   o * output_scale + (output_scale - 1) / 2 in the output space of the spline, e.g. a coarse preview
+    # input_matrix, input_offset: affine map from the input space of the spline to the indices of image (e.g. the
+    #   composed scaling and linear transformation of get_composed_matrix), applied in the same interpolation
+    # tps_fun: already fitted map from output to input indices (e.g. the inverse of a transforms.TpsTransform) used
+    #   instead of fitting a spline on control_coord and target_coord
+    # The coordinates and spline coefficients are computed in float32 when the output is float32 (get_compute_dtype)
+    z_size, y_size, x_size = image.shape[0:3] if output_shape is None else output_shape
+    n_voxels = z_size * y_size * x_size
+    # Fit the spline which maps output indices to input indices
+    if tps_fun is None:
+        tps_fun = ThinPlateSpline(0.5)
+        tps_fun.fit(target_coord, control_coord)
+    if grid_spacing is not None:
+        logger.info('Evaluating TPS on a coarse grid (spacing %s voxels)...', grid_spacing)
+        spline_shape = tuple(int(np.ceil(size * output_scale)) for size in (z_size, y_size, x_size))
+        displacement_grid = _tps_displacement_grid(tps_fun, spline_shape, grid_spacing)
+        if grid_order > 1:
+            displacement_grid = np.stack([ndi.spline_filter(component, order=grid_order, mode='mirror')
+                                          for component in displacement_grid])
+        max_error = tps_grid_max_error(tps_fun, displacement_grid, grid_spacing, grid_order)
+        logger.info('\tMaximum displacement error against the exact TPS: %s voxels', max_error)
+    # Spline-prefilter every channel once (same filter map_coordinates would apply on each call)
+    if output is None:
+        output = allocate_array((z_size, y_size, x_size, image.shape[3]), image.dtype, scratch_directory)
+    compute_dtype = get_compute_dtype(output.dtype)
+    filtered_channels = _spline_prefilter(image, workers, scratch_directory, compute_dtype)
+    output_flat = output.reshape(n_voxels, -1)
+    n_control = len(tps_fun.control_points) if grid_spacing is None else 0
+    chunk_voxels = _tps_chunk_voxels(n_control, x_size, image.shape[3],
+                                     max_memory_mb / _resolve_workers(workers))
+    if _resolve_workers(workers) > 1:
+        # Make sure there are enough chunks to keep every worker busy
+        chunk_voxels = min(chunk_voxels, max(x_size, n_voxels // (4 * _resolve_workers(workers)) // x_size * x_size))
+
+    def warp_chunk(chunk_start):
+        chunk_stop = min(chunk_start + chunk_voxels, n_voxels)
+        # Output indices of this chunk; Shape: (N, 3)
+        output_indices = np.stack(np.unravel_index(np.arange(chunk_start, chunk_stop), (z_size, y_size, x_size)),
+                                  axis=1).astype(compute_dtype)
+        if output_scale != 1:
+            output_indices = output_indices * output_scale + (output_scale - 1) / 2
+        # Transform them into the input indices
+        if grid_spacing is None:
+            input_indices = _evaluate_spline(tps_fun, output_indices, dtype=compute_dtype).T
+        else:
+            input_indices = output_indices.T + _interpolate_displacement_grid(displacement_grid, output_indices.T,
+                                                                              grid_spacing, grid_order)
+        if input_matrix is not None:
+            input_indices = np.asarray(input_matrix, dtype=compute_dtype) @ input_indices + \
+                np.asarray(input_offset, dtype=compute_dtype)[:, None]
+        # Interpolate the chunk for each channel
+        for channel_idx, filtered in enumerate(filtered_channels):
+            output_flat[chunk_start:chunk_stop, channel_idx] = map_coordinates(filtered, input_indices,
+                                                                               output=output.dtype, prefilter=False)
+
+    _parallel_map(warp_chunk, range(0, n_voxels, chunk_voxels), workers)
+    return output, tps_fun
+
+
+@instrumented
+def build_pyramid(image, n_levels, pyramid_directory=None, dtype=np.float32, scratch_directory=None):
+    # Multi-resolution pyramid of a ZYXC image: [image, image binned by 2, by 4, ...] with up to n_levels binned
+    # levels, each binned from the previous one with downsample
+    # pyramid_directory: write the binned levels to level_<k>.npy files there; they are returned memory-mapped, so that
+    #   they can be displayed lazily
+    pyramid = [image]
+    for level in range(1, n_levels + 1):
+        if min(pyramid[-1].shape[0:3]) < 2:
+            break
+        level_shape = tuple(int(np.ceil(size / 2)) for size in pyramid[-1].shape[0:3]) + (image.shape[3],)
+        if pyramid_directory is None:
+            level_image = allocate_array(level_shape, dtype, scratch_directory)
+        else:
+            level_image = np.lib.format.open_memmap(os.path.join(pyramid_directory, f'level_{level}.npy'), mode='w+',
+                                                    dtype=dtype, shape=level_shape)
+        pyramid.append(downsample(pyramid[-1], 2, output=level_image))
+    return pyramid
+
+
+def get_level_matrix(matrix, offset, bin_factor, level_factor):
+    # Convert a map onto the indices of the image binned by bin_factor into a map onto the indices of the image binned
+    # by level_factor (bins are centred: raw index = factor * binned index + (factor - 1) / 2)
+    scale = bin_factor / level_factor
+    return scale * np.asarray(matrix), scale * np.asarray(offset) + (bin_factor - level_factor) / (2 * level_factor)
+
+
+@instrumented
+def level_transform_image(image_level, level_factor, image_shape, pixel_size, transform_matrix, bin_factor=1,
+                          control_coord=None, target_coord=None, output_scale=None, grid_spacing=None, workers=1,
+                          scratch_directory=None, tps_fun=None):
+    # Composed scaling, linear and - if control_coord and target_coord are given - TPS transformation of an image,
+    # sampled from a pyramid level (the raw image binned by level_factor) in a single interpolation
+    # image_shape, pixel_size: shape and pixel size of the raw image
+    # transform_matrix, control_coord, target_coord: as for composed_transform_image and tps_transform_image, in
+    #   pixels of the full resolution output (the raw image binned by bin_factor and scaled)
+    # tps_fun: already fitted spline from output to linearly transformed indices, instead of control/target_coord
+    # output_scale: output pixels are output_scale times larger than the full resolution output; default: the ratio
+    #   of the level to the full resolution (e.g. a quick preview from a coarse level)
+    # Returns the transformed image and its pixel size
+    if output_scale is None:
+        output_scale = max(1, level_factor / bin_factor)
+    output_shape, matrix, offset = get_composed_matrix(image_shape, pixel_size, transform_matrix, bin_factor)
+    matrix, offset = get_level_matrix(matrix, offset, bin_factor, level_factor)
+    output_shape = tuple(int(np.ceil(size / output_scale)) for size in output_shape)
+    logger.info('Transforming the pyramid level binned by %s onto a grid of %s...', level_factor, output_shape)
+    if control_coord is None and tps_fun is None:
+        # Output voxel o lies at o * output_scale + (output_scale - 1) / 2 of the full resolution output
+        image_transformed = _affine_resample(image_level, matrix * output_scale,
+                                             offset + matrix @ np.full(3, (output_scale - 1) / 2), output_shape,
+                                             image_level.dtype, workers, scratch_directory)
+    else:
+        image_transformed, _ = tps_transform_image(image_level, control_coord, target_coord,
+                                                   grid_spacing=grid_spacing, workers=workers,
+                                                   scratch_directory=scratch_directory, output_shape=output_shape,
+                                                   output_scale=output_scale, input_matrix=matrix, input_offset=offset,
+                                                   tps_fun=tps_fun)
+    output_pixel_size = pixel_size[2] * bin_factor * output_scale
+    return image_transformed, [output_pixel_size, output_pixel_size, output_pixel_size]
+
+
+def get_intensity_range(image, block_planes=16):
+    # Minimum and maximum intensity of a ZYXC image, computed in one pass over blocks of z-planes
+    data_min = None
+    data_max = None
+    for z_start in range(0, image.shape[0], block_planes):
+        block = np.asarray(image[z_start:z_start + block_planes])
+        block_min = block.min()
+        block_max = block.max()
+        data_min = block_min if data_min is None else min(data_min, block_min)
+        data_max = block_max if data_max is None else max(data_max, block_max)
+    return data_min, data_max
+
+
+def _iter_converted_blocks(image, keep_dtype, block_planes):
+    # Yield blocks of z-planes of a ZYXC image, converted to UINT16 (stretched to the full intensity range of the
+    # image) unless keep_dtype; only one block is converted at a time
+    if not keep_dtype:
+        data_min, data_max = get_intensity_range(image, block_planes)
+        data_range = data_max - data_min
+        data_scale = 65535.0 / data_range if data_range > 0 else 0.0
+    for z_start in range(0, image.shape[0], block_planes):
+        block = np.asarray(image[z_start:z_start + block_planes])
+        if not keep_dtype:
+            # Stretched in float32 for float32 images, in float64 otherwise
+            block = np.subtract(block, data_min, dtype=get_compute_dtype(block.dtype))
+            block *= data_scale
+            block = block.astype('uint16')
+        yield z_start, block
+
+
+def _iter_tif_pages(image, keep_dtype, block_planes, tile):
+    # Pages (or tiles of pages) of the image in ImageJ ZCYX order
+    for _, block in _iter_converted_blocks(image, keep_dtype, block_planes):
+        for plane in block:
+            for channel in range(plane.shape[2]):
+                page = plane[:, :, channel]
+                if tile is None:
+                    yield page
+                    continue
+                for y_start in range(0, page.shape[0], tile[0]):
+                    for x_start in range(0, page.shape[1], tile[1]):
+                        # Edge tiles are padded to the full tile size
+                        page_tile = np.zeros(tile, dtype=page.dtype)
+                        tile_data = page[y_start:y_start + tile[0], x_start:x_start + tile[1]]
+                        page_tile[:tile_data.shape[0], :tile_data.shape[1]] = tile_data
+                        yield page_tile
+
+
+def _save_ome_zarr(image_path, image, keep_dtype, block_planes, pixel_size):
+    # Write the image as a single resolution OME-Zarr (v0.4) with a CZYX array
+    import zarr
+    z_size, y_size, x_size, n_channels = image.shape
+    dtype = image.dtype if keep_dtype else np.uint16
+    try:
+        group = zarr.open_group(image_path, mode='w', zarr_format=2)
+    except TypeError:
+        # zarr < 3
+        group = zarr.open_group(image_path, mode='w')
+    create_array = getattr(group, 'create_array', None) or group.create_dataset
+    data = create_array('0', shape=(n_channels, z_size, y_size, x_size), dtype=dtype,
+                        chunks=(1, min(block_planes, z_size), min(256, y_size), min(256, x_size)))
+    for z_start, block in _iter_converted_blocks(image, keep_dtype, block_planes):
+        data[:, z_start:z_start + block.shape[0]] = block.transpose(3, 0, 1, 2)
+    scale = [1.0] + ([float(size) for size in pixel_size] if pixel_size is not None else [1.0, 1.0, 1.0])
+    group.attrs['multiscales'] = [{
+        'version': '0.4',
+        'axes': [{'name': 'c', 'type': 'channel'}] + [{'name': axis, 'type': 'space', 'unit': 'micrometer'}
+                                                       for axis in 'zyx'],
+        'datasets': [{'path': '0', 'coordinateTransformations': [{'type': 'scale', 'scale': scale}]}],
+    }]
+
+
+@instrumented
+def save_image(image_path, image, keep_dtype=False, compression=None, compression_level=None, tile=None, bigtiff=None,
+               block_planes=16, workers=None, pixel_size=None):
+    # Write a ZYXC image block by block (block_planes z-planes at a time)
+    # By default the image is converted to UINT16 stretched to its full intensity range and saved as an ImageJ (ZCYX)
+    # tif. keep_dtype: save the source dtype without rescaling
+    # compression ('zlib', 'zstd', ... with an optional compression_level), tile ((Y, X) tile size) or bigtiff write an
+    # OME-TIFF instead, compressed on workers threads
+    # An image_path ending with .zarr is written as OME-Zarr (requires zarr)
+    if image_path.endswith('.zarr'):
+        _save_ome_zarr(image_path, image, keep_dtype, block_planes, pixel_size)
+        return image_path
+    dtype = np.dtype(image.dtype) if keep_dtype else np.dtype(np.uint16)
+    z_size, y_size, x_size, n_channels = image.shape
+    # Convert image to ZCYX format (ImageJ) page by page
+    pages = _iter_tif_pages(image, keep_dtype, block_planes, tile)
+    use_imagej = compression is None and tile is None and not bigtiff and dtype in (np.uint8, np.uint16, np.float32)
+    if use_imagej:
+        imwrite(image_path, pages, shape=(z_size, n_channels, y_size, x_size), dtype=dtype, imagej=True,
+                metadata={'axes': 'ZCYX'})
+    else:
+        if bigtiff is None:
+            # Classic tif files are limited to 4 GB
+            bigtiff = z_size * n_channels * y_size * x_size * dtype.itemsize > 2 ** 32 - 2 ** 25
+        compressionargs = {'level': compression_level} if compression_level is not None else None
+        imwrite(image_path, pages, shape=(z_size, n_channels, y_size, x_size), dtype=dtype, ome=True,
+                metadata={'axes': 'ZCYX'}, compression=compression, compressionargs=compressionargs, tile=tile,
+                bigtiff=bigtiff, maxworkers=workers)
+    return image_path
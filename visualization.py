@@ -0,0 +1,153 @@
+import numpy as np
+from swc_io import read_swc, get_sections
+from coordinates import um_to_pixel
+
+# Path simplification tolerances (in trace pixels) precomputed for the neurite layers; 0 keeps every point
+DECIMATION_TOLERANCES = (0, 1, 2, 4, 8, 16, 32)
+# Colours of the layers, as in the original display of main2.py
+COLORS = {
+    'raw': {'axon': '#ca6e38', 'dendrite': '#a7993f', 'points': '#cb5462'},
+    'linear': {'axon': '#44bdc1', 'dendrite': '#62b64c', 'points': '#559961'},
+    'tps': {'axon': '#c65ea0', 'dendrite': '#6e87cc', 'points': '#9061cb'},
+}
+SECTION_TYPES = {'axon': 2, 'dendrite': 3}
+
+
+def get_multiscale_levels(volume, max_display_size=1024):
+    # Views of a ZYX volume subsampled by 1, 2, 4, ... along every axis, down to the first level whose largest side is
+    # at most max_display_size. The levels are strided views: nothing is copied, and for memory-mapped volumes nothing
+    # is read until napari displays a level (in 3D napari renders the coarsest level, in 2D the visible tiles)
+    levels = [volume]
+    while max(levels[-1].shape) > max_display_size and min(levels[-1].shape) > 1:
+        factor = 2 ** len(levels)
+        levels.append(volume[::factor, ::factor, ::factor])
+    return levels
+
+
+def get_contrast_limits(levels):
+    # Intensity range taken from the coarsest level, so that napari does not scan the full resolution volume
+    coarsest = np.asarray(levels[-1])
+    minimum, maximum = float(coarsest.min()), float(coarsest.max())
+    return [minimum, maximum if maximum > minimum else minimum + 1]
+
+
+def get_neurite_paths(swc_path, pixel_size, use_cache=False):
+    # Neurite sections of a swc file merged by type: {'axon': (points, section_ids), 'dendrite': ...}
+    # points: (N, 3) ZYX pixel coordinates of all sections one after the other; section_ids: (N,) section of each point
+    swc_data, _ = read_swc(swc_path, use_cache=use_cache)
+    sections = get_sections(swc_data)
+    paths = {}
+    for name, section_type in SECTION_TYPES.items():
+        coords = [coord for coord_type, coord in sections if coord_type == section_type]
+        if not coords:
+            paths[name] = (np.empty((0, 3)), np.empty(0, dtype=np.int64))
+            continue
+        points = np.flip(um_to_pixel(np.concatenate(coords), pixel_size), axis=1)
+        section_ids = np.repeat(np.arange(len(coords)), [len(coord) for coord in coords])
+        paths[name] = (points, section_ids)
+    return paths
+
+
+def decimate_paths(points, section_ids, tolerance):
+    # Keep the first and last point of every section and, in between, one point per tolerance of path length
+    n_points = len(points)
+    if tolerance <= 0 or n_points == 0:
+        return points, section_ids
+    starts_section = np.ones(n_points, dtype=bool)
+    starts_section[1:] = section_ids[1:] != section_ids[:-1]
+    ends_section = np.ones(n_points, dtype=bool)
+    ends_section[:-1] = starts_section[1:]
+    # Path length from the start of the section of each point
+    step = np.zeros(n_points)
+    step[1:] = np.linalg.norm(np.diff(points, axis=0), axis=1)
+    step[starts_section] = 0
+    cumulative_length = np.cumsum(step)
+    section_start = np.maximum.accumulate(np.where(starts_section, np.arange(n_points), 0))
+    bucket = np.floor((cumulative_length - cumulative_length[section_start]) / tolerance)
+    keep = starts_section | ends_section
+    keep[1:] |= bucket[1:] != bucket[:-1]
+    return points[keep], section_ids[keep]
+
+
+def paths_to_vectors(points, section_ids):
+    # Segments between consecutive points of the same section, in the napari Vectors format: (S, 2, 3) of
+    # [start point, end point - start point]
+    same_section = section_ids[1:] == section_ids[:-1]
+    return np.stack([points[:-1][same_section], np.diff(points, axis=0)[same_section]], axis=1)
+
+
+def get_decimated_vectors(points, section_ids, tolerances=DECIMATION_TOLERANCES):
+    # Vectors of the paths at every decimation tolerance
+    return [paths_to_vectors(*decimate_paths(points, section_ids, tolerance)) for tolerance in tolerances]
+
+
+def add_volume(viewer, volume, name, scale=1, max_display_size=1024):
+    # Add every channel of a ZYXC volume (or of a list of ZYXC pyramid levels, finest first) as a multiscale layer
+    for channel in range(volume[0].shape[3] if isinstance(volume, list) else volume.shape[3]):
+        if isinstance(volume, list):
+            levels = [level[:, :, :, channel] for level in volume]
+        else:
+            levels = get_multiscale_levels(volume[:, :, :, channel], max_display_size)
+        viewer.add_image(levels if len(levels) > 1 else levels[0], multiscale=len(levels) > 1,
+                         scale=[scale] * 3 if np.isscalar(scale) else scale,
+                         contrast_limits=get_contrast_limits(levels), name=name + ' ' + str(channel))
+
+
+def add_neurites(viewer, swc_path, pixel_size, name, colors, use_cache=False, decimation_pixels=2.0,
+                 tolerances=DECIMATION_TOLERANCES):
+    # Add the axon and dendrite of a swc file as one Vectors layer each. The paths are simplified according to the
+    # zoom of the camera so that no segment is shorter than about decimation_pixels screen pixels.
+    layers = []
+    for neurite_name, (points, section_ids) in get_neurite_paths(swc_path, pixel_size, use_cache).items():
+        if len(points) == 0:
+            continue
+        vectors = get_decimated_vectors(points, section_ids, tolerances)
+        layer = viewer.add_vectors(vectors[0], edge_width=1.0, edge_color=colors[neurite_name],
+                                   name=name + ' ' + neurite_name)
+        layer.metadata['decimated_vectors'] = vectors
+        layer.metadata['decimation_level'] = 0
+        layers.append(layer)
+
+    def update_decimation(event=None):
+        # Data units per screen pixel is 1 / zoom; use the coarsest tolerance below decimation_pixels screen pixels
+        tolerance = decimation_pixels / max(viewer.camera.zoom, 1e-12)
+        level = max(index for index, level_tolerance in enumerate(tolerances) if level_tolerance <= tolerance)
+        for layer in layers:
+            if layer.metadata['decimation_level'] != level:
+                layer.metadata['decimation_level'] = level
+                layer.data = layer.metadata['decimated_vectors'][level]
+
+    viewer.camera.events.zoom.connect(update_decimation)
+    update_decimation()
+    return layers
+
+
+def show_results(results, do_tps=True, use_cache=False, max_display_size=1024, decimation_pixels=2.0):
+    # Display the volumes, traces and landmarks of register_specimen in napari without copying the volumes
+    import napari
+    pixel_size = results['pixel_size']
+    viewer = napari.Viewer(ndisplay=3)
+
+    # Raw image (its pyramid in pyramid mode) in the pixel units of the traces: no scaled copy is computed
+    raw_scale = np.asarray(results['raw_pixel_size']) / pixel_size[2]
+    add_volume(viewer, results['image'] if results['pyramid'] is None else results['pyramid'], 'raw', raw_scale,
+               max_display_size)
+    add_neurites(viewer, results['swc_file_path'], pixel_size, 'raw', COLORS['raw'], use_cache, decimation_pixels)
+    viewer.add_points(results['control_coord_pixels'], size=10, face_color=[COLORS['raw']['points']])
+
+    image_LT, image_LT_scale = results['image_LT'], 1
+    if image_LT is None:
+        # Pyramid mode with TPS: only the preview of the linear transformation is computed
+        image_LT, image_LT_scale = results['preview_LT'], results['preview_pixel_size'][2] / pixel_size[2]
+    add_volume(viewer, image_LT, 'linear', image_LT_scale, max_display_size)
+    add_neurites(viewer, results['linear_transformed_swc_path'], pixel_size, 'linear', COLORS['linear'], use_cache,
+                 decimation_pixels)
+    viewer.add_points(results['linear_transformed_control_coord_pixels'], size=10,
+                      face_color=[COLORS['linear']['points']])
+
+    if do_tps:
+        add_volume(viewer, results['image_TPS'], 'tps', 1, max_display_size)
+        add_neurites(viewer, results['tps_transformed_swc_path'], pixel_size, 'tps', COLORS['tps'], use_cache,
+                     decimation_pixels)
+        viewer.add_points(results['target_coord_pixels'], size=10, face_color=[COLORS['tps']['points']])
+    return viewer